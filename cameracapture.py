@@ -0,0 +1,1682 @@
+#!/usr/bin/env python3
+
+import os, sys, ctypes, ctypes.util, logging, mmap, struct, getopt, select, time, math, json, socket, stat
+from fcntl import ioctl
+from threading import Thread, Lock, Condition, Event
+from queue import Queue
+from collections import deque
+
+from cameractrls import CameraCtrls, subscribe_ctrl_events, dequeue_ctrl_event, str2pxf, pxf2str, _IOW
+from cameractrls import v4l2_capability, v4l2_format, v4l2_streamparm, v4l2_requestbuffers, v4l2_buffer, v4l2_exportbuffer
+from cameractrls import VIDIOC_QUERYCAP, VIDIOC_G_FMT, VIDIOC_G_PARM, VIDIOC_S_PARM
+from cameractrls import VIDIOC_REQBUFS, VIDIOC_QUERYBUF, VIDIOC_EXPBUF, VIDIOC_QBUF, VIDIOC_DQBUF, VIDIOC_STREAMON, VIDIOC_STREAMOFF
+from cameractrls import V4L2_CAP_VIDEO_CAPTURE, V4L2_CAP_STREAMING, V4L2_MEMORY_MMAP, V4L2_MEMORY_USERPTR, V4L2_BUF_TYPE_VIDEO_CAPTURE
+from cameractrls import V4L2_BUF_FLAG_TIMESTAMP_MASK, V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC
+from cameractrls import V4L2_PIX_FMT_YUYV, V4L2_PIX_FMT_YVYU, V4L2_PIX_FMT_UYVY, V4L2_PIX_FMT_YU12, V4L2_PIX_FMT_YV12
+from cameractrls import V4L2_PIX_FMT_NV12, V4L2_PIX_FMT_NV21, V4L2_PIX_FMT_GREY
+from cameractrls import V4L2_PIX_FMT_RGB24, V4L2_PIX_FMT_BGR24, V4L2_PIX_FMT_RX24
+from cameractrls import V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG
+
+# turbojpeg is needed only for decoding and encoding, the capture works without it
+turbojpeglib = ctypes.util.find_library('turbojpeg')
+turbojpeg = ctypes.CDLL(turbojpeglib) if turbojpeglib is not None else None
+
+if turbojpeg is not None:
+    tj_init_decompress = turbojpeg.tjInitDecompress
+    tj_init_decompress.restype = ctypes.c_void_p
+    #tjhandle tjInitDecompress()
+
+    tj_decompress = turbojpeg.tjDecompress2
+    tj_decompress.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong,
+        ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int]
+    tj_decompress.restype = ctypes.c_int
+    #int tjDecompress2(tjhandle handle,
+    #                  const unsigned char *jpegBuf, unsigned long jpegSize,
+    #                  unsigned char *dstBuf,
+    #                  int width, int pitch, int height, int pixelFormat,
+    #                  int flags);
+
+    tj_decompress_header = turbojpeg.tjDecompressHeader3
+    tj_decompress_header.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong,
+        ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+    tj_decompress_header.restype = ctypes.c_int
+    #int tjDecompressHeader3(tjhandle handle,
+    #                        const unsigned char *jpegBuf, unsigned long jpegSize,
+    #                        int *width, int *height,
+    #                        int *jpegSubsamp, int *jpegColorspace);
+
+    tj_decompress_yuv = turbojpeg.tjDecompressToYUVPlanes
+    tj_decompress_yuv.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong,
+        ctypes.POINTER(ctypes.c_void_p),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+        ctypes.c_int]
+    tj_decompress_yuv.restype = ctypes.c_int
+    #int tjDecompressToYUVPlanes(tjhandle handle,
+    #                            const unsigned char *jpegBuf, unsigned long jpegSize,
+    #                            unsigned char **dstPlanes,
+    #                            int width, int *strides, int height,
+    #                            int flags);
+
+    tj_buf_size_yuv = turbojpeg.tjBufSizeYUV2
+    tj_buf_size_yuv.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    tj_buf_size_yuv.restype = ctypes.c_ulong
+    #unsigned long tjBufSizeYUV2(int width, int pad, int height, int subsamp);
+
+    tj_decompress_to_yuv = turbojpeg.tjDecompressToYUV2
+    tj_decompress_to_yuv.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong,
+        ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int]
+    tj_decompress_to_yuv.restype = ctypes.c_int
+    #int tjDecompressToYUV2(tjhandle handle,
+    #                       const unsigned char *jpegBuf, unsigned long jpegSize,
+    #                       unsigned char *dstBuf,
+    #                       int width, int pad, int height, int flags);
+
+    tj_decode_yuv = turbojpeg.tjDecodeYUV
+    tj_decode_yuv.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int]
+    tj_decode_yuv.restype = ctypes.c_int
+    #int tjDecodeYUV(tjhandle handle,
+    #                const unsigned char *srcBuf, int pad, int subsamp,
+    #                unsigned char *dstBuf,
+    #                int width, int pitch, int height, int pixelFormat,
+    #                int flags);
+
+    tj_decode_yuv_planes = turbojpeg.tjDecodeYUVPlanes
+    tj_decode_yuv_planes.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+        ctypes.POINTER(ctypes.c_ubyte),
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int]
+    tj_decode_yuv_planes.restype = ctypes.c_int
+    #int tjDecodeYUVPlanes(tjhandle handle,
+    #                      const unsigned char **srcPlanes, const int *strides, int subsamp,
+    #                      unsigned char *dstBuf,
+    #                      int width, int pitch, int height, int pixelFormat,
+    #                      int flags);
+
+    tj_init_compress = turbojpeg.tjInitCompress
+    tj_init_compress.restype = ctypes.c_void_p
+    #tjhandle tjInitCompress()
+
+    tj_compress = turbojpeg.tjCompress2
+    tj_compress.argtypes = [ctypes.c_void_p,
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    tj_compress.restype = ctypes.c_int
+    #int tjCompress2(tjhandle handle,
+    #                const unsigned char *srcBuf, int width, int pitch, int height, int pixelFormat,
+    #                unsigned char **jpegBuf, unsigned long *jpegSize,
+    #                int jpegSubsamp, int jpegQual, int flags);
+
+    tj_compress_yuv = turbojpeg.tjCompressFromYUVPlanes
+    tj_compress_yuv.argtypes = [ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)), ctypes.POINTER(ctypes.c_ulong),
+        ctypes.c_int, ctypes.c_int]
+    tj_compress_yuv.restype = ctypes.c_int
+    #int tjCompressFromYUVPlanes(tjhandle handle,
+    #                            const unsigned char **srcPlanes, int width, const int *strides, int height, int subsamp,
+    #                            unsigned char **jpegBuf, unsigned long *jpegSize,
+    #                            int jpegQual, int flags);
+
+    tj_free = turbojpeg.tjFree
+    tj_free.argtypes = [ctypes.c_void_p]
+    tj_free.restype = None
+    #void tjFree(unsigned char *buffer);
+
+    tj_get_error_str = turbojpeg.tjGetErrorStr
+    tj_get_error_str.restype = ctypes.c_char_p
+    #char* tjGetErrorStr()
+
+    tj_destroy = turbojpeg.tjDestroy
+    tj_destroy.argtypes = [ctypes.c_void_p]
+    tj_destroy.restype = ctypes.c_int
+    # int tjDestroy(tjhandle handle);
+
+TJPF_RGB = 0
+TJPF_BGR = 1
+TJPF_RGBX = 2
+TJPF_GRAY = 6
+
+TJSAMP_422 = 1
+TJSAMP_420 = 2
+TJSAMP_GRAY = 3
+
+# the scaling factors of turbojpeg are 1/scale
+TJ_SCALES = [8, 4, 2]
+
+def tj_scaled(dim, scale):
+    return (dim + scale - 1) // scale
+
+# the capture buffers are sized to the fps and the latency of the consumer (in seconds),
+# which is measured from DQBUF to QBUF
+MIN_CAP_BUFS = 2
+MAX_CAP_BUFS = 32
+INITIAL_CONSUMER_LATENCY = 0.1
+CAP_BUFS_MEMORY = 128 * 1024 * 1024
+
+# the number of the parallel mjpeg decoders
+MJPEG_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+def percentiles_ms(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {f'p{p}': round(values[len(values) * p // 100] * 1000, 3) for p in [50, 95, 99]}
+
+# accounts the frames by the sequence numbers and the timestamps of the driver,
+# the sequence gaps are dropped before the driver (e.g. usb bandwidth),
+# the capture to present latency grows with a slow decoder or renderer
+class FrameStats():
+    def __init__(self, fps, window=1000):
+        self.nominal_fps = fps
+        self.frames = 0
+        self.drops = 0
+        self.last_seq = None
+        self.last_ts = None
+        self.intervals = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.lock = Lock()
+
+    # returns the capture time in time.monotonic() seconds
+    def capture(self, buf):
+        ts = time.monotonic()
+        if buf.flags & V4L2_BUF_FLAG_TIMESTAMP_MASK == V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC:
+            ts = buf.timestamp.secs + buf.timestamp.usecs / 1000000
+        self.add(buf.sequence, ts)
+        return ts
+
+    def add(self, sequence, ts):
+        with self.lock:
+            if self.last_seq is not None and sequence > self.last_seq + 1:
+                self.drops += sequence - self.last_seq - 1
+            if self.last_ts is not None:
+                self.intervals.append(ts - self.last_ts)
+            self.last_seq = sequence
+            self.last_ts = ts
+            self.frames += 1
+
+    def present(self, captured):
+        with self.lock:
+            self.latencies.append(time.monotonic() - captured)
+
+    def summary(self):
+        with self.lock:
+            intervals = list(self.intervals)
+            latencies = list(self.latencies)
+            frames = self.frames
+            drops = self.drops
+
+        period = 1 / self.nominal_fps if self.nominal_fps else 0
+        return {
+            'frames': frames,
+            'sequence_drops': drops,
+            'nominal_fps': round(self.nominal_fps, 3),
+            'fps': round(len(intervals) / sum(intervals), 3) if sum(intervals) > 0 else 0,
+            'interval_ms': percentiles_ms(intervals),
+            'jitter_ms': percentiles_ms([abs(i - period) for i in intervals]),
+            'latency_ms': percentiles_ms(latencies),
+        }
+
+class V4L2Camera(Thread):
+    def __init__(self, device, ring_depth=0):
+        super().__init__()
+        self.device = device
+        self.width = 0
+        self.height = 0
+        self.pixelformat = 0
+        self.bytesperline = 0
+        self.sizeimage = 0
+        self.fps = 0
+        self.stopped = False
+        self.pipe = None
+        self.num_cap_bufs = 0
+        self.cap_bufs = []
+        self.consumer_latency = INITIAL_CONSUMER_LATENCY
+        # with ring_depth the frames are captured into our own buffers (USERPTR)
+        self.ring_depth = ring_depth
+        self.ring = []
+        self.ring_addrs = []
+        self.free_slots = deque()
+        self.starved_bufs = deque()
+        # the slots kept by keep_buf, with the number of their keepers
+        self.kept_slots = {}
+        # bumped by free_buffers, the buffers of an earlier allocation are not requeued
+        self.generation = 0
+        self.lock = Lock()
+        # the capture loop waits on the device and on this, see call and stop_capturing
+        self.wakeup = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+        self.commands = deque()
+        self.epoll = None
+        self.streaming = False
+        self.event_ctrls = None
+        self.ctrl_cb = None
+
+        try:
+            # the capture loop waits on epoll, a spurious wakeup must not block it in DQBUF
+            self.fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK, 0)
+        except Exception as e:
+            logging.error(f'os.open: {e}')
+            sys.exit(3)
+
+        self.init_device()
+        if not self.init_buffers():
+            sys.exit(3)
+
+        self.stats = FrameStats(self.fps)
+
+
+    def init_device(self):
+        cap = v4l2_capability()
+        ioctl(self.fd, VIDIOC_QUERYCAP, cap)
+
+        if not (cap.capabilities & V4L2_CAP_VIDEO_CAPTURE):
+            logging.error(f'{self.device} is not a video capture device')
+            sys.exit(3)
+
+        if not (cap.capabilities & V4L2_CAP_STREAMING):
+            logging.error(f'{self.device} does not support streaming i/o')
+            sys.exit(3)
+
+        parm = v4l2_streamparm()
+        parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+
+        # Razer Kiyo Pro and Microsoft Lifecam HD-3000 need
+        # to set FPS before first streaming
+        ioctl(self.fd, VIDIOC_G_PARM, parm)
+
+        try:
+            ioctl(self.fd, VIDIOC_S_PARM, parm)
+        except Exception as e:
+            logging.error(f'VIDIOC_S_PARM failed {self.device}: {e}')
+            sys.exit(3)
+
+        self.read_format()
+
+    def read_format(self):
+        fmt = v4l2_format()
+        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        ioctl(self.fd, VIDIOC_G_FMT, fmt)
+
+        parm = v4l2_streamparm()
+        parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        ioctl(self.fd, VIDIOC_G_PARM, parm)
+
+        self.width = fmt.fmt.pix.width
+        self.height = fmt.fmt.pix.height
+        self.pixelformat = fmt.fmt.pix.pixelformat
+        self.bytesperline = fmt.fmt.pix.bytesperline
+        self.sizeimage = fmt.fmt.pix.sizeimage
+
+        tpf = parm.parm.capture.timeperframe
+        self.fps = tpf.denominator / tpf.numerator if tpf.numerator else 30
+
+    # sets the format with the V4L2FmtCtrls params, the stream has to be off, the buffers
+    # are reallocated in place, sized to the new format, fps and the measured latency
+    def set_format(self, fmt_ctrls, params, errs):
+        self.free_buffers()
+        fmt_ctrls.setup_ctrls(params, errs)
+        self.read_format()
+        self.stats = FrameStats(self.fps)
+        return self.init_buffers()
+
+    # enough buffers to cover the latency of the consumer at the current fps,
+    # plus one being filled and one being consumed, within the memory budget
+    def wanted_cap_bufs(self):
+        count = math.ceil(self.consumer_latency * self.fps) + 2
+        if self.sizeimage:
+            count = min(count, CAP_BUFS_MEMORY // self.sizeimage)
+        return max(MIN_CAP_BUFS, min(count, MAX_CAP_BUFS))
+
+    # the driver may grant more or less than asked
+    def request_buffers(self, memory, count):
+        req = v4l2_requestbuffers()
+
+        req.count = count
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = memory
+
+        ioctl(self.fd, VIDIOC_REQBUFS, req)
+        return req.count
+
+    def init_buffers(self):
+        wanted = self.wanted_cap_bufs()
+        memory = V4L2_MEMORY_MMAP
+        count = 0
+
+        if self.ring_depth:
+            try:
+                count = self.request_buffers(V4L2_MEMORY_USERPTR, wanted)
+                memory = V4L2_MEMORY_USERPTR
+            except Exception as e:
+                logging.info(f'USERPTR is not supported on {self.device}, using mmap: {e}')
+
+        if memory == V4L2_MEMORY_MMAP:
+            try:
+                count = self.request_buffers(V4L2_MEMORY_MMAP, wanted)
+            except Exception as e:
+                logging.error(f'Video buffer request failed on {self.device}: {e}')
+                return False
+
+        if count < MIN_CAP_BUFS:
+            logging.error(f'Insufficient buffer memory on {self.device}')
+            return False
+
+        if count != wanted:
+            logging.info(f'{self.device}: got {count} capture buffers instead of {wanted}')
+        self.num_cap_bufs = count
+
+        if memory == V4L2_MEMORY_USERPTR:
+            self.init_userptr_buffers()
+        else:
+            self.init_mmap_buffers()
+        return True
+
+    def init_mmap_buffers(self):
+        for i in range(self.num_cap_bufs):
+            buf = v4l2_buffer()
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_MMAP
+            buf.index = i
+
+            ioctl(self.fd, VIDIOC_QUERYBUF, buf)
+
+            buf.buffer = mmap.mmap(self.fd, buf.length,
+                flags=mmap.MAP_SHARED | 0x08000, #MAP_POPULATE
+                prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                offset=buf.m.offset)
+
+            buf.dequeued = None
+            buf.holds = 0
+            buf.generation = self.generation
+            self.cap_bufs.append(buf)
+
+    # the ring can be deeper than the queue of the driver, so the frames can be kept
+    # with keep_buf while their v4l2 buffers are requeued with other slots
+    def init_userptr_buffers(self):
+        depth = self.ring_depth
+        if depth < self.num_cap_bufs:
+            logging.warning(f'the ring depth {depth} is less than the {self.num_cap_bufs} capture buffers, using {self.num_cap_bufs}')
+            depth = self.num_cap_bufs
+
+        # anonymous mappings are page-aligned
+        size = (self.sizeimage + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.ring = [mmap.mmap(-1, size) for i in range(depth)]
+        self.ring_addrs = [ctypes.addressof(ctypes.c_char.from_buffer(m)) for m in self.ring]
+        self.free_slots.extend(range(depth))
+
+        for i in range(self.num_cap_bufs):
+            buf = v4l2_buffer()
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_USERPTR
+            buf.index = i
+            buf.length = size
+            buf.buffer = None
+            buf.slot = None
+            buf.dequeued = None
+            buf.holds = 0
+            buf.generation = self.generation
+            self.cap_bufs.append(buf)
+
+    # the stream has to be off, the mappings still in use are unmapped when they are released
+    def free_buffers(self):
+        memory = self.cap_bufs[0].memory if self.cap_bufs else V4L2_MEMORY_MMAP
+        for buf in self.cap_bufs:
+            if buf.memory == V4L2_MEMORY_MMAP:
+                try:
+                    buf.buffer.close()
+                except BufferError:
+                    pass
+        with self.lock:
+            self.generation += 1
+            self.cap_bufs = []
+            self.ring = []
+            self.ring_addrs = []
+            self.free_slots.clear()
+            self.starved_bufs.clear()
+            self.kept_slots.clear()
+
+        try:
+            self.request_buffers(memory, 0)
+        except Exception as e:
+            logging.warning(f'VIDIOC_REQBUFS(0) failed {self.device}: {e}')
+
+    # the dmabuf fds of the capture buffers for another process,
+    # None with USERPTR or when VIDIOC_EXPBUF is not supported
+    def export_buffers(self):
+        if not self.cap_bufs or self.cap_bufs[0].memory != V4L2_MEMORY_MMAP:
+            return None
+        fds = []
+        for buf in self.cap_bufs:
+            expbuf = v4l2_exportbuffer()
+            expbuf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            expbuf.index = buf.index
+            # writable, so ctypes can point into the mappings of the consumer
+            expbuf.flags = os.O_RDWR | os.O_CLOEXEC
+            try:
+                ioctl(self.fd, VIDIOC_EXPBUF, expbuf)
+            except Exception as e:
+                logging.warning(f'VIDIOC_EXPBUF failed {self.device}: {e}')
+                for fd in fds:
+                    os.close(fd)
+                return None
+            fds.append(expbuf.fd)
+        return fds
+
+    def capture_loop(self):
+        # frames, control events and the wakeups in one place
+        self.epoll = select.epoll()
+        self.epoll.register(self.fd, select.EPOLLPRI)
+        self.epoll.register(self.wakeup, select.EPOLLIN)
+
+        if not self.stream_on():
+            self.pipe.write_buf(None)
+            return
+
+        qbuf = v4l2_buffer()
+        qbuf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+
+        timeout = 0
+
+        try:
+            while not self.stopped:
+                # DQBUF can block forever, so wait with 1s timeout before
+                # quit after 5s
+                events = self.epoll.poll(1)
+                if len(events) == 0:
+                    if not self.streaming:
+                        continue
+                    logging.warning(f'{self.device}: timeout occured')
+                    timeout += 1
+                    if timeout == 5:
+                        self.pipe.write_buf(None)
+                        return
+                    continue
+
+                for fd, mask in events:
+                    if fd == self.wakeup:
+                        os.eventfd_read(self.wakeup)
+                        self.run_commands()
+                        continue
+                    if mask & select.EPOLLPRI:
+                        self.dequeue_ctrl_event()
+                    if not self.streaming:
+                        continue
+                    qbuf.memory = self.cap_bufs[0].memory
+                    if mask & (select.EPOLLIN | select.EPOLLERR) and not self.dequeue_buf(qbuf):
+                        self.pipe.write_buf(None)
+                        return
+        finally:
+            self.epoll.close()
+
+        self.stream_off()
+
+    # called on the capture thread
+    def stream_on(self):
+        try:
+            ioctl(self.fd, VIDIOC_STREAMON, struct.pack('I', V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        except Exception as e:
+            logging.error(f'VIDIOC_STREAMON failed {self.device}: {e}')
+            return False
+
+        for buf in self.cap_bufs:
+            buf.holds = 1
+            self.queue_buf(buf)
+
+        self.streaming = True
+        # a device without streaming signals POLLERR
+        self.epoll.modify(self.fd, select.EPOLLIN | select.EPOLLPRI)
+        return True
+
+    # called on the capture thread
+    def stream_off(self):
+        self.streaming = False
+        if not self.epoll.closed:
+            self.epoll.modify(self.fd, select.EPOLLPRI)
+
+        try:
+            ioctl(self.fd, VIDIOC_STREAMOFF, struct.pack('I', V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        except Exception as e:
+            logging.error(f'VIDIOC_STREAMOFF failed {self.device}: {e}')
+
+    def dequeue_buf(self, qbuf):
+        try:
+            ioctl(self.fd, VIDIOC_DQBUF, qbuf)
+        except BlockingIOError:
+            return True
+        except Exception as e:
+            logging.error(f'VIDIOC_DQBUF failed {self.device}: {e}')
+            return False
+
+        buf = self.cap_bufs[qbuf.index]
+        buf.bytesused = qbuf.bytesused
+        buf.timestamp = qbuf.timestamp
+        buf.sequence = qbuf.sequence
+        buf.dequeued = time.monotonic()
+        buf.captured = self.stats.capture(qbuf)
+        buf.holds = 1
+
+        # the pipe gives the buffer back with queue_buf when it's done with it
+        self.pipe.write_buf(buf)
+        return True
+
+    # the events update the values of ctrls, cb is called with the changed controls on the capture thread
+    def listen_ctrls(self, ctrls, cb=None):
+        errs = []
+        if not subscribe_ctrl_events(self.fd, ctrls, errs):
+            logging.warning(f'listen_ctrls: {errs}')
+            return
+        self.event_ctrls = ctrls
+        self.ctrl_cb = cb
+
+    def dequeue_ctrl_event(self):
+        if self.event_ctrls is None:
+            return
+        errs = []
+        ctrl = dequeue_ctrl_event(self.fd, self.event_ctrls, errs)
+        if errs:
+            logging.warning(f'dequeue_ctrl_event: {errs}')
+        if ctrl is not None and self.ctrl_cb is not None:
+            self.ctrl_cb(ctrl)
+
+    # runs fn on the capture thread between two frames, e.g. to reconfigure the stream
+    def call(self, fn):
+        self.commands.append(fn)
+        os.eventfd_write(self.wakeup, 1)
+
+    # runs fn on the capture thread and waits for its result, None if the thread is gone
+    def call_sync(self, fn):
+        done = Event()
+        result = []
+        def run():
+            try:
+                result.append(fn())
+            finally:
+                done.set()
+        self.call(run)
+        while not done.wait(0.1):
+            if not self.is_alive():
+                return None
+        return result[0] if result else None
+
+    def run_commands(self):
+        while self.commands:
+            self.commands.popleft()()
+
+    # another consumer (e.g. the recorder) holds the buffer, it is requeued
+    # only after every holder gave it back with queue_buf
+    def hold_buf(self, buf):
+        with self.lock:
+            buf.holds += 1
+
+    def queue_buf(self, buf):
+        with self.lock:
+            buf.holds -= 1
+            # a snapshot or a recording held it across a format switch
+            if buf.holds > 0 or buf.generation != self.generation:
+                return
+
+        self.measure_latency(buf)
+        if buf.memory == V4L2_MEMORY_MMAP:
+            self.qbuf(buf)
+            return
+
+        with self.lock:
+            if buf.slot is not None:
+                if buf.slot not in self.kept_slots:
+                    self.free_slots.append(buf.slot)
+                buf.slot = None
+            self.starved_bufs.append(buf)
+            self.requeue_starved()
+
+    # gives back a hold of the buffer like queue_buf, but keeps its frame in self.ring[slot]
+    # until release_slot with buf.generation, the v4l2 buffer is requeued with another slot after the other holders,
+    # returns None with mmap, then the buffer has to be held
+    def keep_buf(self, buf):
+        if buf.memory == V4L2_MEMORY_MMAP:
+            return None
+
+        with self.lock:
+            slot = buf.slot
+            self.kept_slots[slot] = self.kept_slots.get(slot, 0) + 1
+        self.queue_buf(buf)
+        return slot
+
+    # a moving average of the time the consumer holds the buffers
+    def measure_latency(self, buf):
+        if buf.dequeued is None:
+            return
+        latency = time.monotonic() - buf.dequeued
+        buf.dequeued = None
+        self.consumer_latency += (latency - self.consumer_latency) / 16
+
+    # generation is the one of the kept buffer
+    def release_slot(self, slot, generation):
+        with self.lock:
+            # the ring was reallocated meanwhile, the slot may be kept in the new one
+            if generation != self.generation:
+                return
+            keepers = self.kept_slots.get(slot)
+            if keepers is None:
+                return
+            if keepers > 1:
+                self.kept_slots[slot] = keepers - 1
+                return
+            del self.kept_slots[slot]
+            # still in a buffer of the other holders, queue_buf frees it
+            if any(buf.slot == slot for buf in self.cap_bufs):
+                return
+            self.free_slots.append(slot)
+            self.requeue_starved()
+
+    # the buffers wait here while all the slots are kept
+    def requeue_starved(self):
+        while self.starved_bufs and self.free_slots:
+            buf = self.starved_bufs.popleft()
+            buf.slot = self.free_slots.popleft()
+            buf.m.userptr = self.ring_addrs[buf.slot]
+            buf.buffer = self.ring[buf.slot]
+            self.qbuf(buf)
+
+    def qbuf(self, buf):
+        try:
+            ioctl(self.fd, VIDIOC_QBUF, buf)
+        except Exception as e:
+            # the stream is already off
+            if not self.stopped:
+                logging.error(f'VIDIOC_QBUF failed {self.device}: {e}')
+
+    def stop_capturing(self):
+        self.stopped = True
+        os.eventfd_write(self.wakeup, 1)
+
+    # thread start
+    def run(self):
+        self.capture_loop()
+    
+    # thread stop
+    def stop(self):
+        self.stop_capturing()
+        self.join()
+
+    # after stop, when no consumer gives back buffers any more
+    def close(self):
+        os.close(self.wakeup)
+        os.close(self.fd)
+
+
+# decodes the mjpeg frames on a pool of workers, each with its own turbojpeg handle,
+# and emits the results in the order of the submission
+class MJPEGDecoder():
+    def __init__(self, width, height, workers, requeue, emit):
+        self.width = width
+        self.height = height
+        self.bytesperline = width * 3
+        # TJPF_GRAY decodes only the luma for the colormaps
+        self.pixelformat = TJPF_RGB
+        # decodes the color frames to yuv planes instead of TJPF_RGB,
+        # skipping the color conversion, when the renderer takes IYUV
+        self.yuv = False
+        # decodes the frames at 1/scale size with a cheaper IDCT
+        self.scale = 1
+        self.requeue = requeue
+        self.emit = emit
+        self.jobs = Queue()
+        # the jobs get their output buffers in the order of the submission, otherwise the later
+        # ones could take all the buffers and wait to be emitted after one which can't get any
+        self.take_lock = Lock()
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        self.pending = deque()
+
+        # the renderer gives the buffers back with release
+        self.outbuffers = []
+        self.free = None
+        self.alloc_outbuffers(workers + 2)
+
+        self.workers = [Thread(target=self.worker, daemon=True) for i in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def alloc_outbuffers(self, count):
+        self.outbuffers = [(ctypes.c_uint8 * (self.width * self.height * 3))() for i in range(count)]
+        self.free = Queue()
+        for i in range(count):
+            self.free.put(i)
+
+    # waits for the submitted frames to be emitted
+    def drain(self):
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+
+    # after drain, and all the buffers are released
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.bytesperline = width * 3
+        self.alloc_outbuffers(len(self.outbuffers))
+
+    def submit(self, buf):
+        job = [buf, None, self.pixelformat, buf.captured, self.scale, None]
+        with self.lock:
+            self.pending.append(job)
+        self.jobs.put(job)
+
+    def worker(self):
+        tj = tj_init_decompress()
+        while True:
+            with self.take_lock:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                idx = self.free.get()
+                if idx is None:
+                    break
+            buf, _, pixelformat, _, scale, _ = job
+            width = tj_scaled(self.width, scale)
+            height = tj_scaled(self.height, scale)
+            ptr = (ctypes.c_uint8 * buf.bytesused).from_buffer(buf.buffer)
+            planes = None
+            if pixelformat == TJPF_RGB and self.yuv:
+                planes = self.decompress_yuv(tj, ptr, buf.bytesused, idx, width, height)
+            if planes is None:
+                pitch = width if pixelformat == TJPF_GRAY else width * 3
+                tj_decompress(tj, ptr, buf.bytesused, self.outbuffers[idx], width, pitch, height, pixelformat, 0)
+            # ignore decode errors, some cameras only send imperfect frames
+            del ptr
+            self.requeue(buf)
+
+            with self.lock:
+                job[1] = idx
+                job[5] = planes
+                while self.pending and self.pending[0][1] is not None:
+                    job = self.pending.popleft()
+                    self.emit(*job[1:])
+                if not self.pending:
+                    self.idle.notify_all()
+        tj_destroy(tj)
+
+    # the planes of the 4:2:0 and 4:2:2 frames as (ptr, pitch) * 3 for IYUV,
+    # the 4:2:2 chroma is shown as 4:2:0 by skipping every second row with the pitch,
+    # returns None for the other subsamplings, those are decoded to TJPF_RGB
+    def decompress_yuv(self, tj, ptr, size, idx, width, height):
+        w = ctypes.c_int()
+        h = ctypes.c_int()
+        subsamp = ctypes.c_int()
+        colorspace = ctypes.c_int()
+        if tj_decompress_header(tj, ptr, size, ctypes.byref(w), ctypes.byref(h), ctypes.byref(subsamp), ctypes.byref(colorspace)) != 0:
+            return None
+        if subsamp.value not in [TJSAMP_420, TJSAMP_422]:
+            return None
+
+        cwidth = (width + 1) // 2
+        cheight = height if subsamp.value == TJSAMP_422 else (height + 1) // 2
+        y = ctypes.addressof(self.outbuffers[idx])
+        u = y + width * height
+        v = u + cwidth * cheight
+        tj_decompress_yuv(tj, ptr, size, (ctypes.c_void_p * 3)(y, u, v), width, (ctypes.c_int * 3)(width, cwidth, cwidth), height, 0)
+
+        cpitch = cwidth * 2 if subsamp.value == TJSAMP_422 else cwidth
+        return (y, width, u, cpitch, v, cpitch)
+
+    def release(self, idx):
+        self.free.put(idx)
+
+    def stop(self):
+        for w in self.workers:
+            self.jobs.put(None)
+        # the workers waiting for a free buffer would never stop
+        for i in range(len(self.workers)):
+            self.free.put(None)
+        for w in self.workers:
+            w.join()
+
+# the recordings start with the format of the stream, followed by the frames as the driver
+# gave them (MJPEG as is, the raw formats with their bytesperline), and end with the index
+# of the frame offsets, the frames of a recording cut short can still be read one by one
+REC_MAGIC = b'V4L2REC1'
+REC_INDEX_MAGIC = b'V4L2IDX1'
+# magic, fourcc, width, height, bytesperline, fps
+REC_HEADER = struct.Struct('<8sIIIId')
+# size, sequence, capture time (CLOCK_MONOTONIC seconds)
+REC_FRAME = struct.Struct('<IId')
+# offset of the index, number of frames, magic
+REC_TRAILER = struct.Struct('<QI8s')
+
+# writes the capture buffers to the disk without copying them, the buffers are held
+# until they are written, the frames are dropped from the recording instead of blocking
+# the capture thread when the queue is full, it holds at most half of the buffers,
+# with USERPTR it keeps the frames in the spare slots of the ring instead,
+# a burst is never dropped from, it holds the buffers as long as it needs them
+class Recorder(Thread):
+    # with limit it stops after that many frames (a burst)
+    def __init__(self, cam, filename, limit=0):
+        super().__init__()
+        self.cam = cam
+        self.filename = filename
+        self.limit = limit
+        self.accepted = 0
+        spare = len(cam.ring) - len(cam.cap_bufs)
+        self.keep = spare > 0
+        if limit:
+            self.frames = Queue()
+        else:
+            self.frames = Queue(spare if self.keep else max(1, len(cam.cap_bufs) // 2))
+        self.offsets = []
+        self.offset = 0
+        self.dropped = 0
+        # the frames the driver skipped while recording, e.g. running out of buffers
+        self.missed = 0
+        self.sequence = None
+        self.failed = False
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        self.write_all([REC_HEADER.pack(REC_MAGIC, cam.pixelformat, cam.width, cam.height, cam.bytesperline, cam.fps)])
+
+    # called on the capture thread
+    def write_buf(self, buf):
+        if self.failed or self.limit and self.accepted >= self.limit:
+            return
+        if self.sequence is not None:
+            self.missed += max(0, buf.sequence - self.sequence - 1)
+        self.sequence = buf.sequence
+        # only the capture thread puts
+        if self.frames.full():
+            self.dropped += 1
+            return
+        # a kept buffer is dequeued again before the frame is written
+        header = REC_FRAME.pack(buf.bytesused, buf.sequence, buf.captured)
+        data = memoryview(buf.buffer)[:buf.bytesused]
+        self.cam.hold_buf(buf)
+        slot = self.cam.keep_buf(buf) if self.keep else None
+        self.frames.put_nowait((header, data, buf, slot))
+        self.accepted += 1
+
+    def write_all(self, data):
+        try:
+            while data:
+                n = os.writev(self.fd, data)
+                self.offset += n
+                while data and n >= len(data[0]):
+                    n -= len(data[0])
+                    data.pop(0)
+                if data:
+                    data[0] = memoryview(data[0])[n:]
+        except OSError as e:
+            logging.error(f'Recorder: writing {self.filename} failed: {e}')
+            self.failed = True
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            header, data, buf, slot = frame
+            if not self.failed:
+                self.offsets.append(self.offset)
+                self.write_all([header, data])
+            data.release()
+            if slot is None:
+                self.cam.queue_buf(buf)
+            else:
+                self.cam.release_slot(slot, buf.generation)
+            if self.limit and len(self.offsets) >= self.limit:
+                break
+
+        if not self.failed:
+            index = struct.pack(f'<{len(self.offsets)}Q', *self.offsets)
+            self.write_all([index, REC_TRAILER.pack(self.offset, len(self.offsets), REC_INDEX_MAGIC)])
+        os.close(self.fd)
+        logging.info(f'Recorder: {len(self.offsets)} frames written to {self.filename}, {self.dropped} dropped, {self.missed} missed by the driver')
+
+    # the capture thread must not call write_buf any more
+    def stop(self):
+        if self.is_alive():
+            self.frames.put(None)
+        self.join()
+
+# the dmabuf export: on connect the client gets the format with the dmabuf fds of the capture
+# buffers (SCM_RIGHTS), then a message per frame, and gives the buffers back by their index
+# fourcc, width, height, bytesperline, sizeimage, number of buffers, fps
+DMABUF_FORMAT = struct.Struct('<IIIIIId')
+# index, bytesused, sequence, capture time (CLOCK_MONOTONIC seconds)
+DMABUF_FRAME = struct.Struct('<IIId')
+# index
+DMABUF_DONE = struct.Struct('<I')
+
+# struct dma_buf_sync { __u64 flags; };
+DMA_BUF_SYNC_READ = 1 << 0
+DMA_BUF_SYNC_START = 0 << 2
+DMA_BUF_SYNC_END = 1 << 2
+DMA_BUF_IOCTL_SYNC = _IOW('b', 0, ctypes.c_uint64)
+
+# hands the capture buffers to one client process at a time without copying them,
+# the buffers are held until the client gives them back, it gets at most half of them,
+# the frames are dropped for the client instead of blocking the capture thread
+class DmabufExporter(Thread):
+    def __init__(self, cam, path):
+        super().__init__()
+        self.cam = cam
+        self.path = path
+        self.lock = Lock()
+        self.client = None
+        self.inflight = {}
+        self.dropped = 0
+        self.stopped = False
+        self.wakeup = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+
+        # a socket left by a previous run
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+        try:
+            self.sock.bind(path)
+            self.sock.listen(1)
+        except OSError:
+            self.sock.close()
+            os.close(self.wakeup)
+            raise
+
+    # called on the capture thread
+    def write_buf(self, buf):
+        with self.lock:
+            if self.client is None:
+                return
+            if len(self.inflight) >= max(1, len(self.cam.cap_bufs) // 2):
+                self.dropped += 1
+                return
+            self.cam.hold_buf(buf)
+            try:
+                self.client.send(DMABUF_FRAME.pack(buf.index, buf.bytesused, buf.sequence, buf.captured), socket.MSG_DONTWAIT | socket.MSG_NOSIGNAL)
+            except OSError:
+                # full or gone, the exporter thread notices a disconnect
+                self.dropped += 1
+                self.cam.queue_buf(buf)
+                return
+            self.inflight[buf.index] = buf
+
+    def run(self):
+        epoll = select.epoll()
+        epoll.register(self.sock.fileno(), select.EPOLLIN)
+        epoll.register(self.wakeup, select.EPOLLIN)
+        try:
+            while not self.stopped:
+                for fd, mask in epoll.poll():
+                    if fd == self.wakeup:
+                        os.eventfd_read(self.wakeup)
+                    elif fd == self.sock.fileno():
+                        self.accept(epoll)
+                    else:
+                        self.receive()
+        finally:
+            epoll.close()
+
+    def accept(self, epoll):
+        conn, _ = self.sock.accept()
+        if self.client is not None:
+            logging.warning(f'DmabufExporter: {self.path} has a client already')
+            conn.close()
+            return
+
+        # the format and the buffers can change only on the capture thread
+        def export():
+            cam = self.cam
+            # between the stream_off and the stream_on of a format switch
+            if not cam.streaming:
+                return None
+            return cam.export_buffers(), DMABUF_FORMAT.pack(cam.pixelformat, cam.width, cam.height, cam.bytesperline, cam.sizeimage, len(cam.cap_bufs), cam.fps)
+        exported = self.cam.call_sync(export)
+        if exported is None or exported[0] is None:
+            conn.close()
+            return
+
+        fds, fmt = exported
+        try:
+            socket.send_fds(conn, [fmt], fds)
+        except OSError as e:
+            logging.warning(f'DmabufExporter: sending the buffers failed: {e}')
+            conn.close()
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        epoll.register(conn.fileno(), select.EPOLLIN)
+        with self.lock:
+            self.client = conn
+        logging.info(f'DmabufExporter: a client connected to {self.path}')
+
+    def receive(self):
+        client = self.client
+        if client is None:
+            return
+        try:
+            data = client.recv(DMABUF_DONE.size)
+        except OSError:
+            data = b''
+        if len(data) != DMABUF_DONE.size:
+            self.disconnect()
+            return
+
+        index, = DMABUF_DONE.unpack(data)
+        with self.lock:
+            buf = self.inflight.pop(index, None)
+        if buf is not None:
+            self.cam.queue_buf(buf)
+
+    # the client gets the new buffers when it connects again
+    def disconnect(self):
+        with self.lock:
+            client = self.client
+            self.client = None
+            bufs = list(self.inflight.values())
+            self.inflight.clear()
+        if client is None:
+            return
+        # the epoll forgets it with the close
+        client.close()
+        for buf in bufs:
+            self.cam.queue_buf(buf)
+        logging.info(f'DmabufExporter: the client of {self.path} disconnected, {self.dropped} frames dropped for it')
+
+    # the capture thread must not call write_buf any more
+    def stop(self):
+        self.stopped = True
+        os.eventfd_write(self.wakeup, 1)
+        self.join()
+        self.disconnect()
+        self.sock.close()
+        os.close(self.wakeup)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+# a capture buffer imported from the dmabuf fd of DmabufExporter
+class DmabufBuffer():
+    def __init__(self, index, fd, length):
+        self.index = index
+        self.fd = fd
+        self.buffer = mmap.mmap(fd, length, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+        self.bytesused = 0
+        self.sequence = 0
+        self.captured = 0
+        self.dequeued = None
+
+    # the cpu caches are synced around the reads
+    def sync(self, flags):
+        try:
+            ioctl(self.fd, DMA_BUF_IOCTL_SYNC, ctypes.c_uint64(DMA_BUF_SYNC_READ | flags))
+        except OSError as e:
+            logging.debug(f'DMA_BUF_IOCTL_SYNC failed: {e}')
+
+# the client of DmabufExporter, it looks like V4L2Camera to its pipe: write_buf gets
+# the imported buffers on this thread, and they are given back with queue_buf
+class DmabufClient(Thread):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.pipe = None
+        self.lock = Lock()
+        self.stopped = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+        try:
+            self.sock.connect(path)
+            data, fds, _, _ = socket.recv_fds(self.sock, DMABUF_FORMAT.size, 64)
+        except OSError:
+            self.sock.close()
+            raise
+        if len(data) != DMABUF_FORMAT.size or not fds:
+            for fd in fds:
+                os.close(fd)
+            self.sock.close()
+            raise OSError(f'{path} didn\'t send the buffers')
+
+        self.pixelformat, self.width, self.height, self.bytesperline, self.sizeimage, count, self.fps = DMABUF_FORMAT.unpack(data)
+        self.bufs = [DmabufBuffer(i, fd, self.sizeimage) for i, fd in enumerate(fds)]
+        self.stats = FrameStats(self.fps)
+
+    def run(self):
+        while not self.stopped:
+            try:
+                data = self.sock.recv(DMABUF_FRAME.size)
+            except OSError:
+                data = b''
+            if len(data) != DMABUF_FRAME.size:
+                break
+            index, bytesused, sequence, captured = DMABUF_FRAME.unpack(data)
+            buf = self.bufs[index]
+            buf.bytesused = bytesused
+            buf.sequence = sequence
+            buf.captured = captured
+            buf.dequeued = time.monotonic()
+            buf.sync(DMA_BUF_SYNC_START)
+            with self.lock:
+                self.stats.add(sequence, captured)
+                self.pipe.write_buf(buf)
+
+        if not self.stopped:
+            logging.error(f'DmabufClient: {self.path} closed the connection')
+            with self.lock:
+                self.pipe.write_buf(None)
+
+    def queue_buf(self, buf):
+        buf.sync(DMA_BUF_SYNC_END)
+        try:
+            self.sock.send(DMABUF_DONE.pack(buf.index), socket.MSG_NOSIGNAL)
+        except OSError:
+            pass
+
+    # the pipe is called with the same lock
+    def call_sync(self, fn):
+        with self.lock:
+            return fn()
+
+    def stop(self):
+        self.stopped = True
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.join()
+
+    def close(self):
+        for buf in self.bufs:
+            buf.buffer.close()
+            os.close(buf.fd)
+        self.sock.close()
+
+JPEG_QUALITY = 90
+
+# the raw formats compressed in place by turbojpeg, as (pixel format, subsampling)
+TJ_PACKED_FORMATS = {
+    V4L2_PIX_FMT_GREY: (TJPF_GRAY, TJSAMP_GRAY),
+    V4L2_PIX_FMT_RGB24: (TJPF_RGB, TJSAMP_422),
+    V4L2_PIX_FMT_BGR24: (TJPF_BGR, TJSAMP_422),
+    V4L2_PIX_FMT_RX24: (TJPF_RGBX, TJSAMP_422),
+}
+
+# the RGB formats as (bytes per pixel, offsets of R, G and B)
+RGB_OFFSETS = {
+    V4L2_PIX_FMT_RGB24: (3, 0, 1, 2),
+    V4L2_PIX_FMT_BGR24: (3, 2, 1, 0),
+    V4L2_PIX_FMT_RX24: (4, 0, 1, 2),
+}
+
+# the offsets of Y, U and V in the packed 4:2:2 formats
+TJ_YUV422_OFFSETS = {
+    V4L2_PIX_FMT_YUYV: (0, 1, 3),
+    V4L2_PIX_FMT_YVYU: (0, 3, 1),
+    V4L2_PIX_FMT_UYVY: (1, 0, 2),
+}
+
+def crop_rows(data, bytesperline, rowbytes, rows):
+    if bytesperline == rowbytes:
+        return data[:rowbytes * rows]
+    return b''.join(data[r * bytesperline : r * bytesperline + rowbytes] for r in range(rows))
+
+# the planes of the yuv formats for tjCompressFromYUVPlanes as (planes, strides, subsampling),
+# the planar ones are used in place, the interleaved ones are split with strided copies
+def yuv_planes(pixelformat, addr, width, height, bytesperline):
+    cwidth = (width + 1) // 2
+    cheight = (height + 1) // 2
+
+    if pixelformat in TJ_YUV422_OFFSETS:
+        y, u, v = TJ_YUV422_OFFSETS[pixelformat]
+        data = crop_rows(ctypes.string_at(addr, bytesperline * height), bytesperline, width * 2, height)
+        return [data[y::2], data[u::4], data[v::4]], [width, width // 2, width // 2], TJSAMP_422
+
+    if pixelformat in [V4L2_PIX_FMT_NV12, V4L2_PIX_FMT_NV21]:
+        uv = crop_rows(ctypes.string_at(addr + bytesperline * height, bytesperline * cheight), bytesperline, cwidth * 2, cheight)
+        u, v = uv[0::2], uv[1::2]
+        if pixelformat == V4L2_PIX_FMT_NV21:
+            u, v = v, u
+        return [addr, u, v], [bytesperline, cwidth, cwidth], TJSAMP_420
+
+    if pixelformat in [V4L2_PIX_FMT_YU12, V4L2_PIX_FMT_YV12]:
+        u = addr + bytesperline * height
+        v = u + bytesperline // 2 * cheight
+        if pixelformat == V4L2_PIX_FMT_YV12:
+            u, v = v, u
+        return [addr, u, v], [bytesperline, bytesperline // 2, bytesperline // 2], TJSAMP_420
+
+    return None
+
+# returns the jpeg as bytes or None when the format is not supported
+def encode_jpeg(pixelformat, addr, width, height, bytesperline):
+    tj = tj_init_compress()
+    jpeg_buf = ctypes.POINTER(ctypes.c_ubyte)()
+    jpeg_size = ctypes.c_ulong()
+    try:
+        if pixelformat in TJ_PACKED_FORMATS:
+            tjpf, subsamp = TJ_PACKED_FORMATS[pixelformat]
+            ret = tj_compress(tj, addr, width, bytesperline, height, tjpf, ctypes.byref(jpeg_buf), ctypes.byref(jpeg_size), subsamp, JPEG_QUALITY, 0)
+        else:
+            yuv = yuv_planes(pixelformat, addr, width, height, bytesperline)
+            if yuv is None:
+                logging.warning(f'encode_jpeg: {pxf2str(pixelformat)} is not supported')
+                return None
+            planes, strides, subsamp = yuv
+            # the split planes are bytes, they are kept alive by planes
+            ptrs = [p if isinstance(p, int) else ctypes.cast(ctypes.c_char_p(p), ctypes.c_void_p).value for p in planes]
+            ret = tj_compress_yuv(tj, (ctypes.c_void_p * 3)(*ptrs), width, (ctypes.c_int * 3)(*strides), height, subsamp, ctypes.byref(jpeg_buf), ctypes.byref(jpeg_size), JPEG_QUALITY, 0)
+        if ret != 0:
+            logging.warning(f'encode_jpeg: {tj_get_error_str().decode()}')
+            return None
+        return ctypes.string_at(jpeg_buf, jpeg_size.value)
+    finally:
+        if jpeg_buf:
+            tj_free(jpeg_buf)
+        tj_destroy(tj)
+
+# writes a frame as a jpeg on its own thread: MJPEG as it came from the camera,
+# the raw formats encoded with turbojpeg, the buffer is held until then
+class Snapshot(Thread):
+    def __init__(self, cam, buf, filename):
+        super().__init__()
+        self.cam = cam
+        self.buf = buf
+        self.filename = filename
+        self.pixelformat = cam.pixelformat
+        self.width = cam.width
+        self.height = cam.height
+        self.bytesperline = cam.bytesperline
+        self.ok = False
+        cam.hold_buf(buf)
+
+    def run(self):
+        try:
+            self.ok = self.write()
+        except OSError as e:
+            logging.error(f'Snapshot: writing {self.filename} failed: {e}')
+        finally:
+            self.cam.queue_buf(self.buf)
+        if self.ok:
+            logging.info(f'Snapshot: {self.filename}')
+
+    def write(self):
+        buf = self.buf
+        if self.pixelformat in [V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG]:
+            with open(self.filename, 'wb') as f:
+                f.write(memoryview(buf.buffer)[:buf.bytesused])
+            return True
+
+        if turbojpeg is None:
+            logging.error('Snapshot: libturbojpeg not found, please install the libturbojpeg package!')
+            return False
+
+        ptr = ctypes.c_char.from_buffer(buf.buffer)
+        try:
+            jpeg = encode_jpeg(self.pixelformat, ctypes.addressof(ptr), self.width, self.height, self.bytesperline)
+        finally:
+            del ptr
+        if jpeg is None:
+            return False
+        with open(self.filename, 'wb') as f:
+            f.write(jpeg)
+        return True
+
+# the auto exposure settles over the first frames
+STILL_SKIP_FRAMES = 5
+STILL_TIMEOUT = 10
+
+# takes a snapshot, or a burst of frames into a recording, for the command line tools
+class StillConsumer():
+    def __init__(self, cam, filename, burst):
+        self.cam = cam
+        self.filename = filename
+        self.burst = burst
+        self.skip = STILL_SKIP_FRAMES
+        self.writer = None
+        self.done = Event()
+
+    def write_buf(self, buf):
+        if buf is None:
+            self.done.set()
+            return
+
+        if self.skip > 0:
+            self.skip -= 1
+        elif not self.done.is_set():
+            self.take(buf)
+        self.cam.queue_buf(buf)
+
+    def take(self, buf):
+        if self.writer is None:
+            try:
+                self.writer = Recorder(self.cam, self.filename, self.burst) if self.burst else Snapshot(self.cam, buf, self.filename)
+            except OSError as e:
+                logging.error(f'StillConsumer: {e}')
+                self.done.set()
+                return
+            self.writer.start()
+
+        if self.burst:
+            self.writer.write_buf(buf)
+            if self.writer.accepted >= self.burst:
+                self.done.set()
+        else:
+            self.done.set()
+
+def capture_stills(device, filename, burst=0):
+    cam = V4L2Camera(device)
+    try:
+        consumer = StillConsumer(cam, filename, burst)
+        cam.pipe = consumer
+        cam.start()
+        if not consumer.done.wait(STILL_TIMEOUT):
+            logging.error(f'capture_stills: no frames from {device}')
+        cam.stop()
+
+        writer = consumer.writer
+        if writer is None:
+            return False
+        if burst:
+            writer.stop()
+            if writer.missed:
+                logging.warning(f'capture_stills: the driver skipped {writer.missed} frames during the burst')
+            return not writer.failed and writer.accepted >= burst
+        writer.join()
+        return writer.ok
+    finally:
+        cam.close()
+
+# times the stages of the frames on the capture thread, when decode is set the frames are
+# converted there to RGB one by one (MJPEG decoded first), so a slow conversion shows up
+# as dropped frames
+class BenchConsumer():
+    def __init__(self, cam, decode):
+        self.cam = cam
+        self.tj = tj_init_decompress() if decode else None
+        self.yuv = None
+        self.rgb = None
+        self.done = Event()
+        self.measuring = False
+        self.failed = False
+        self.limit = 0
+        self.result = None
+
+    # called on the capture thread
+    def start(self, limit):
+        self.limit = limit
+        self.frames = 0
+        self.dequeue = []
+        self.decode = []
+        self.convert = []
+        self.cam.stats = FrameStats(self.cam.fps)
+        self.result = None
+        self.done.clear()
+        self.started = time.monotonic()
+        self.cpu_started = time.process_time()
+        self.measuring = True
+
+    # called on the capture thread
+    def stop(self):
+        if not self.measuring:
+            return
+        self.measuring = False
+        duration = time.monotonic() - self.started
+        cpu = time.process_time() - self.cpu_started
+        self.result = {
+            'pixelformat': pxf2str(self.cam.pixelformat),
+            'resolution': f'{self.cam.width}x{self.cam.height}',
+            'duration_s': round(duration, 3),
+            **self.cam.stats.summary(),
+            'dequeue_ms': percentiles_ms(self.dequeue),
+            'decode_ms': percentiles_ms(self.decode),
+            'convert_ms': percentiles_ms(self.convert),
+            'cpu_s': round(cpu, 3),
+            'cpu_percent': round(cpu / duration * 100, 1) if duration else None,
+        }
+        self.done.set()
+
+    def write_buf(self, buf):
+        if buf is None:
+            self.failed = True
+            self.stop()
+            self.done.set()
+            return
+
+        if self.measuring:
+            # from the driver timestamp to the return of DQBUF
+            self.dequeue.append(buf.dequeued - buf.captured)
+            if self.tj is not None and self.cam.pixelformat in [V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG]:
+                self.decode_buf(buf)
+            elif self.tj is not None:
+                self.convert_buf(buf)
+
+        self.cam.stats.present(buf.captured)
+        self.cam.queue_buf(buf)
+
+        if self.measuring:
+            self.frames += 1
+            if self.limit and self.frames >= self.limit:
+                self.stop()
+
+    # decode is the jpeg to yuv part (huffman, idct), convert is the yuv to rgb part
+    def decode_buf(self, buf):
+        ptr = (ctypes.c_uint8 * buf.bytesused).from_buffer(buf.buffer)
+        width = ctypes.c_int()
+        height = ctypes.c_int()
+        subsamp = ctypes.c_int()
+        colorspace = ctypes.c_int()
+        if tj_decompress_header(self.tj, ptr, buf.bytesused, ctypes.byref(width), ctypes.byref(height), ctypes.byref(subsamp), ctypes.byref(colorspace)) != 0:
+            del ptr
+            return
+        width = width.value
+        height = height.value
+        subsamp = subsamp.value
+
+        size = tj_buf_size_yuv(width, 1, height, subsamp)
+        if self.yuv is None or len(self.yuv) < size:
+            self.yuv = (ctypes.c_uint8 * size)()
+        if self.rgb is None or len(self.rgb) < width * height * 3:
+            self.rgb = (ctypes.c_uint8 * (width * height * 3))()
+
+        start = time.perf_counter()
+        # ignore decode errors, some cameras only send imperfect frames
+        tj_decompress_to_yuv(self.tj, ptr, buf.bytesused, self.yuv, width, 1, height, 0)
+        decoded = time.perf_counter()
+        tj_decode_yuv(self.tj, self.yuv, 1, subsamp, self.rgb, width, width * 3, height, TJPF_RGB, 0)
+        converted = time.perf_counter()
+        del ptr
+
+        self.decode.append(decoded - start)
+        self.convert.append(converted - decoded)
+
+    # convert is the raw to rgb part: turbojpeg for the yuv formats, after splitting the interleaved
+    # ones into planes, strided copies for the rgb orders
+    def convert_buf(self, buf):
+        cam = self.cam
+        width = cam.width
+        height = cam.height
+        if self.rgb is None or len(self.rgb) < width * height * 3:
+            self.rgb = (ctypes.c_uint8 * (width * height * 3))()
+
+        ptr = ctypes.c_char.from_buffer(buf.buffer)
+        addr = ctypes.addressof(ptr)
+        start = time.perf_counter()
+        try:
+            if cam.pixelformat in RGB_OFFSETS:
+                size, r, g, b = RGB_OFFSETS[cam.pixelformat]
+                data = crop_rows(ctypes.string_at(addr, cam.bytesperline * height), cam.bytesperline, width * size, height)
+                if (size, r, g, b) == (3, 0, 1, 2):
+                    rgb = data
+                else:
+                    rgb = bytearray(width * height * 3)
+                    rgb[0::3] = data[r::size]
+                    rgb[1::3] = data[g::size]
+                    rgb[2::3] = data[b::size]
+                memoryview(self.rgb).cast('B')[:len(rgb)] = rgb
+            else:
+                if cam.pixelformat == V4L2_PIX_FMT_GREY:
+                    yuv = [addr], [cam.bytesperline], TJSAMP_GRAY
+                else:
+                    yuv = yuv_planes(cam.pixelformat, addr, width, height, cam.bytesperline)
+                if yuv is None:
+                    return
+                planes, strides, subsamp = yuv
+                # the split planes are bytes, they are kept alive by planes
+                ptrs = [p if isinstance(p, int) else ctypes.cast(ctypes.c_char_p(p), ctypes.c_void_p).value for p in planes]
+                ptrs += [None] * (3 - len(ptrs))
+                strides += [0] * (3 - len(strides))
+                if tj_decode_yuv_planes(self.tj, (ctypes.c_void_p * 3)(*ptrs), (ctypes.c_int * 3)(*strides), subsamp, self.rgb, width, width * 3, height, TJPF_RGB, 0) != 0:
+                    logging.warning(f'BenchConsumer: {tj_get_error_str().decode()}')
+                    return
+            converted = time.perf_counter()
+        finally:
+            del ptr
+
+        self.convert.append(converted - start)
+
+    def close(self):
+        if self.tj is not None:
+            tj_destroy(self.tj)
+
+# streams the current format for frames or seconds, whichever comes first
+def bench(cam, consumer, frames, seconds):
+    cam.call_sync(lambda: consumer.start(frames))
+    if not consumer.done.wait(seconds):
+        cam.call_sync(consumer.stop)
+    return consumer.result
+
+# the resolutions depend on the pixelformat, so they are set one after the other
+def switch_format(cam, fmt_ctrls, pixelformat, resolution):
+    errs = []
+    def switch():
+        cam.stream_off()
+        if not cam.set_format(fmt_ctrls, {'pixelformat': pixelformat}, errs):
+            return False
+        fmt_ctrls.get_format_ctrls()
+        if not cam.set_format(fmt_ctrls, {'resolution': resolution}, errs):
+            return False
+        fmt_ctrls.get_format_ctrls()
+        return cam.stream_on()
+    ok = cam.call_sync(switch)
+    if errs:
+        logging.warning(f'switch_format: {errs}')
+    return ok
+
+def usage():
+    print(f'usage: {sys.argv[0]} [--help] [-d DEVICE] [-n FRAMES] [-s SECONDS] [-j] [-a] [-u DEPTH] [-x SOCKET] [-o OUTPUT]\n')
+    print(f'optional arguments:')
+    print(f'  -h, --help         show this help message and exit')
+    print(f'  -d DEVICE          use DEVICE, default /dev/video0')
+    print(f'  -n FRAMES          stop after FRAMES frames, default unset')
+    print(f'  -s SECONDS         stop after SECONDS seconds, default 5')
+    print(f'  -j                 convert the frames to RGB with turbojpeg (MJPEG to YUV first)')
+    print(f'  -a                 bench every pixel format and resolution of the device')
+    print(f'  -u DEPTH           capture into a ring of DEPTH own buffers (USERPTR), default mmap')
+    print(f'  -x SOCKET          bench the frames of cameraview -e SOCKET (dmabuf), not a device')
+    print(f'  -o OUTPUT          write the results as JSON to OUTPUT, default stdout')
+    print()
+    print(f'example:')
+    print(f'  {sys.argv[0]} -d /dev/video2 -a -j')
+
+def main():
+    logging.getLogger().setLevel(logging.INFO)
+
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], 'hd:n:s:jau:x:o:', ['help'])
+    except getopt.error as err:
+        print(err)
+        usage()
+        return 2
+
+    device = '/dev/video0'
+    frames = 0
+    seconds = 5
+    decode = False
+    all_formats = False
+    ring_depth = 0
+    export = None
+    output = '-'
+
+    for current_argument, current_value in arguments:
+        if current_argument in ('-h', '--help'):
+            usage()
+            return 0
+        elif current_argument == '-d':
+            device = current_value
+        elif current_argument == '-n':
+            frames = int(current_value)
+        elif current_argument == '-s':
+            seconds = float(current_value)
+        elif current_argument == '-j':
+            decode = True
+        elif current_argument == '-a':
+            all_formats = True
+        elif current_argument == '-u':
+            ring_depth = int(current_value)
+        elif current_argument == '-x':
+            export = current_value
+        elif current_argument == '-o':
+            output = current_value
+
+    if decode and turbojpeg is None:
+        logging.error('libturbojpeg not found, please install the libturbojpeg package!')
+        return 2
+
+    if export is not None and all_formats:
+        logging.error('-a switches the format of a device, it does not work with -x')
+        return 2
+
+    if export is not None:
+        try:
+            cam = DmabufClient(export)
+        except OSError as e:
+            logging.error(f'cannot import the buffers of {export}: {e}')
+            return 1
+    else:
+        cam = V4L2Camera(device, ring_depth)
+        fmt_ctrls = CameraCtrls(device, cam.fd).fmt_ctrls
+    consumer = BenchConsumer(cam, decode)
+    cam.pipe = consumer
+
+    current = {'pixelformat': pxf2str(cam.pixelformat), 'resolution': f'{cam.width}x{cam.height}'}
+    runs = [current]
+    if all_formats:
+        runs = [{'pixelformat': pixelformat, 'resolution': resolution}
+            for pixelformat in fmt_ctrls.get_fmts()
+            for resolution in fmt_ctrls.get_resolutions(str2pxf(pixelformat))]
+
+    results = []
+    cam.start()
+    for params in runs:
+        if consumer.failed:
+            break
+        if params != current:
+            if not switch_format(cam, fmt_ctrls, params['pixelformat'], params['resolution']):
+                logging.warning(f'skipping {params}')
+                continue
+            current = params
+        result = bench(cam, consumer, frames, seconds)
+        if result is None:
+            break
+        logging.info(f'{result["pixelformat"]} {result["resolution"]}: {result["fps"]} fps, {result["sequence_drops"]} dropped, {result["cpu_percent"]}% cpu')
+        results.append(result)
+    cam.stop()
+    cam.close()
+    consumer.close()
+
+    data = json.dumps(results, indent=2)
+    if output == '-':
+        print(data)
+    else:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+
+    return 0 if results and not consumer.failed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
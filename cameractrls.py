@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-import ctypes, ctypes.util, logging, os.path, getopt, sys, subprocess, select, time, math, configparser
+import ctypes, ctypes.util, logging, os.path, getopt, sys, subprocess, select, time, math, configparser, json, hashlib, tempfile
 from fcntl import ioctl
 from threading import Thread
-from errno import EIO
+from errno import EIO, ENOTTY, EAGAIN, ENOENT
 
 ghurl = 'https://github.com/soyersoyer/cameractrls'
 version = 'v0.6.10'
@@ -40,9 +40,12 @@ class Device:
     def __str__(self):
         return f'"{self.name}" at {self.path}{" -> " + self.real_path if self.real_path != self.path else ""}'
 
+# a wedged device shouldn't stall the listing
+DEVICE_PROBE_TIMEOUT = 2.0
+
 def get_devices(dirs):
-    devices = []
-    resolved_devices = []
+    # dedupe by the real path before opening anything, the first path wins
+    paths = {}
     for dir, prefix in dirs.items():
         if not os.path.isdir(dir):
             continue
@@ -50,18 +53,74 @@ def get_devices(dirs):
             if not device.startswith(prefix):
                 continue
             device = dir + device
-            resolved = device if not os.path.islink(device) else os.path.abspath(dir + os.readlink(device))
-            if resolved in resolved_devices:
-                continue
-            caps = get_device_capability(device)
-            if not(caps.device_caps & V4L2_CAP_VIDEO_CAPTURE):
-                continue
-            name = f'{caps.card.decode()} ({resolved})'
-            devices.append(Device(name, device, resolved, str(caps.driver)))
-            resolved_devices.append(resolved)
+            paths.setdefault(os.path.realpath(device), device)
+
+    # only the nodes which udev doesn't rule out are opened
+    to_probe = {}
+    for resolved, device in paths.items():
+        if not_capture_in_udev(resolved):
+            continue
+        to_probe[resolved] = device
+
+    devices = []
+    caps = get_device_capabilities(to_probe.values(), DEVICE_PROBE_TIMEOUT)
+    for resolved, device in to_probe.items():
+        cap = caps.get(device)
+        if cap is None or not(cap.device_caps & V4L2_CAP_VIDEO_CAPTURE):
+            continue
+        name = f'{cap.card.decode()} ({resolved})'
+        devices.append(Device(name, device, resolved, cap.driver.decode()))
     devices.sort()
     return devices
 
+UDEV_DATA_DIR = '/run/udev/data'
+
+def read_udev_properties(devnum):
+    props = {}
+    try:
+        with open(f'{UDEV_DATA_DIR}/c{devnum}', 'r') as f:
+            for line in f:
+                if line.startswith('E:'):
+                    k, _, v = line[2:].rstrip('\n').partition('=')
+                    props[k] = v
+    except Exception as e:
+        logging.debug(f'read_udev_properties({devnum}) failed: {e}')
+    return props
+
+# True when the udev database knows that the node is not a video capture (e.g. a uvc metadata node),
+# a capture in it is not conclusive: v4l_id reports the mplane devices as capture too, and
+# its older versions report the capabilities of the whole device, so the metadata nodes as well
+def not_capture_in_udev(device):
+    devfile = f'/sys/class/video4linux/{os.path.basename(device)}/dev'
+    devnum = read_usb_id_from_file(devfile) if os.path.isfile(devfile) else ''
+    if not devnum:
+        return False
+
+    # v4l_id puts the capabilities into the udev database
+    capabilities = read_udev_properties(devnum).get('ID_V4L_CAPABILITIES')
+    if capabilities is None:
+        return False
+    return ':capture:' not in capabilities
+
+# probes the devices concurrently, the ones not answering in time are left out
+def get_device_capabilities(devices, timeout):
+    probes = []
+    for device in devices:
+        result = {}
+        thread = Thread(target=lambda d=device, r=result: r.setdefault('cap', get_device_capability(d)), daemon=True)
+        thread.start()
+        probes.append((device, thread, result))
+
+    caps = {}
+    deadline = time.monotonic() + timeout
+    for device, thread, result in probes:
+        thread.join(max(0, deadline - time.monotonic()))
+        if thread.is_alive():
+            logging.warning(f'get_device_capabilities: {device} didn\'t answer in {timeout}s, skipping')
+            continue
+        caps[device] = result.get('cap')
+    return caps
+
 ptz_hw_executables = [
     f'{sys.path[0]}/cameraptzspnav.py',
     f'{sys.path[0]}/cameraptzgame.py',
@@ -247,6 +306,10 @@ V4L2_PIX_FMT_RX24 = v4l2_fourcc('R', 'X', '2', '4')
 
 V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
 V4L2_MEMORY_MMAP = 1
+V4L2_MEMORY_USERPTR = 2
+
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0x0000e000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x00002000
 
 class v4l2_fmtdesc(ctypes.Structure):
     _fields_ = [
@@ -434,6 +497,16 @@ class v4l2_buffer(ctypes.Structure):
         ('reserved', ctypes.c_uint32),
     ]
 
+class v4l2_exportbuffer(ctypes.Structure):
+    _fields_ = [
+        ('type', v4l2_buf_type),
+        ('index', ctypes.c_uint32),
+        ('plane', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('fd', ctypes.c_int32),
+        ('reserved', ctypes.c_uint32 * 11),
+    ]
+
 v4l2_frmsizetypes = enum
 (
     V4L2_FRMSIZE_TYPE_DISCRETE,
@@ -564,6 +637,7 @@ VIDIOC_S_FMT = _IOWR('V', 5, v4l2_format)
 VIDIOC_REQBUFS = _IOWR('V', 8, v4l2_requestbuffers)
 VIDIOC_QUERYBUF	= _IOWR('V', 9, v4l2_buffer)
 VIDIOC_QBUF = _IOWR('V', 15, v4l2_buffer)
+VIDIOC_EXPBUF = _IOWR('V', 16, v4l2_exportbuffer)
 VIDIOC_DQBUF = _IOWR('V', 17, v4l2_buffer)
 VIDIOC_STREAMON = _IOW('V', 18, ctypes.c_int)
 VIDIOC_STREAMOFF = _IOW('V', 19, ctypes.c_int)
@@ -587,9 +661,18 @@ v4l2_ctrl_type = enum
     V4L2_CTRL_TYPE_INTEGER_MENU,
 ) = range(1, 10)
 
+V4L2_CTRL_COMPOUND_TYPES = 0x0100
+V4L2_CTRL_TYPE_U8 = 0x0100
+V4L2_CTRL_TYPE_U16 = 0x0101
+V4L2_CTRL_TYPE_U32 = 0x0102
+V4L2_CTRL_TYPE_AREA = 0x0106
+
+V4L2_CTRL_MAX_DIMS = 4
+
 V4L2_CTRL_FLAG_READ_ONLY = 0x0004
 V4L2_CTRL_FLAG_UPDATE = 0x0008
 V4L2_CTRL_FLAG_INACTIVE = 0x0010
+V4L2_CTRL_FLAG_WRITE_ONLY = 0x0040
 V4L2_CTRL_FLAG_NEXT_CTRL = 0x80000000
 V4L2_CTRL_FLAG_NEXT_COMPOUND = 0x40000000
 
@@ -818,6 +901,29 @@ class v4l2_queryctrl(ctypes.Structure):
         ('reserved', ctypes.c_uint32 * 2),
     ]
 
+class v4l2_query_ext_ctrl(ctypes.Structure):
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('name', ctypes.c_char * 32),
+        ('minimum', ctypes.c_int64),
+        ('maximum', ctypes.c_int64),
+        ('step', ctypes.c_uint64),
+        ('default', ctypes.c_int64),
+        ('flags', ctypes.c_uint32),
+        ('elem_size', ctypes.c_uint32),
+        ('elems', ctypes.c_uint32),
+        ('nr_of_dims', ctypes.c_uint32),
+        ('dims', ctypes.c_uint32 * V4L2_CTRL_MAX_DIMS),
+        ('reserved', ctypes.c_uint32 * 32),
+    ]
+
+class v4l2_area(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+    ]
+
 class v4l2_querymenu(ctypes.Structure):
     class _u(ctypes.Union):
         _fields_ = [
@@ -834,6 +940,40 @@ class v4l2_querymenu(ctypes.Structure):
     _anonymous_ = ('_u',)
     _pack_ = True
 
+class v4l2_ext_control(ctypes.Structure):
+    class _u(ctypes.Union):
+        _fields_ = [
+            ('value', ctypes.c_int32),
+            ('value64', ctypes.c_int64),
+            ('ptr', ctypes.c_void_p),
+        ]
+
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('size', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32 * 1),
+        ('_u', _u),
+    ]
+    _anonymous_ = ('_u',)
+    _pack_ = True
+
+class v4l2_ext_controls(ctypes.Structure):
+    class _u(ctypes.Union):
+        _fields_ = [
+            ('ctrl_class', ctypes.c_uint32),
+            ('which', ctypes.c_uint32),
+        ]
+
+    _fields_ = [
+        ('_u', _u),
+        ('count', ctypes.c_uint32),
+        ('error_idx', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+        ('reserved', ctypes.c_uint32 * 1),
+        ('controls', ctypes.POINTER(v4l2_ext_control)),
+    ]
+    _anonymous_ = ('_u',)
+
 class uvc_xu_control_query(ctypes.Structure):
     _fields_ = [
         ('unit', ctypes.c_uint8),
@@ -909,6 +1049,10 @@ VIDIOC_G_CTRL = _IOWR('V', 27, v4l2_control)
 VIDIOC_S_CTRL = _IOWR('V', 28, v4l2_control)
 VIDIOC_QUERYCTRL = _IOWR('V', 36, v4l2_queryctrl)
 VIDIOC_QUERYMENU = _IOWR('V', 37, v4l2_querymenu)
+VIDIOC_G_EXT_CTRLS = _IOWR('V', 71, v4l2_ext_controls)
+VIDIOC_S_EXT_CTRLS = _IOWR('V', 72, v4l2_ext_controls)
+VIDIOC_TRY_EXT_CTRLS = _IOWR('V', 73, v4l2_ext_controls)
+VIDIOC_QUERY_EXT_CTRL = _IOWR('V', 103, v4l2_query_ext_ctrl)
 VIDIOC_DQEVENT = _IOR('V', 89, v4l2_event)
 VIDIOC_SUBSCRIBE_EVENT = _IOW('V', 90, v4l2_event_subscription)
 VIDIOC_UNSUBSCRIBE_EVENT = _IOW('V', 91, v4l2_event_subscription)
@@ -1008,26 +1152,33 @@ def query_xu_control(fd, unit_id, selector, query, data):
         logging.warning(f'UVCIOC_CTRL_QUERY (0x{query:02x}) - Fd: {fd} - Error: {e}')
 
 # the usb device descriptors file contains the descriptors in a binary format
-# the byte before the extension guid is the extension unit id
-def find_unit_id_in_sysfs(device, guid):
+def read_descriptors_in_sysfs(device):
     if os.path.islink(device):
         device = os.readlink(device)
     device = os.path.basename(device)
     descfile = f'/sys/class/video4linux/{device}/../../../descriptors'
     if not os.path.isfile(descfile):
-        return 0
+        return b''
 
     try:
         with open(descfile, 'rb') as f:
-            descriptors = f.read()
-            guid_start = descriptors.find(guid)
-            if guid_start > 0:
-                return descriptors[guid_start - 1]
+            return f.read()
     except Exception as e:
-        logging.warning(f'Failed to read uvc xu unit id from {descfile}: {e}')
+        logging.warning(f'Failed to read usb descriptors from {descfile}: {e}')
+
+    return b''
+
+# the byte before the extension guid is the extension unit id
+def find_unit_id_in_descriptors(descriptors, guid):
+    guid_start = descriptors.find(guid)
+    if guid_start > 0:
+        return descriptors[guid_start - 1]
 
     return 0
 
+def find_unit_id_in_sysfs(device, guid):
+    return find_unit_id_in_descriptors(read_descriptors_in_sysfs(device), guid)
+
 def find_usb_ids_in_sysfs(device):
     if os.path.islink(device):
         device = os.readlink(device)
@@ -1042,6 +1193,37 @@ def find_usb_ids_in_sysfs(device):
 
     return vendor + ':' + product
 
+# the firmware revision of the usb device
+def find_bcd_device_in_sysfs(device):
+    if os.path.islink(device):
+        device = os.readlink(device)
+    device = os.path.basename(device)
+    bcdfile = f'/sys/class/video4linux/{device}/../../../bcdDevice'
+    if not os.path.isfile(bcdfile):
+        return ''
+
+    return read_usb_id_from_file(bcdfile)
+
+# the index of the video node within the usb interface
+def find_index_in_sysfs(device):
+    if os.path.islink(device):
+        device = os.readlink(device)
+    device = os.path.basename(device)
+    indexfile = f'/sys/class/video4linux/{device}/index'
+    if not os.path.isfile(indexfile):
+        return ''
+
+    return read_usb_id_from_file(indexfile)
+
+# the usb identity and the descriptors of the camera, read once per open
+class UsbInfo:
+    def __init__(self, device):
+        self.usb_ids = find_usb_ids_in_sysfs(device)
+        self.descriptors = read_descriptors_in_sysfs(device)
+
+    def find_unit_id(self, guid):
+        return find_unit_id_in_descriptors(self.descriptors, guid)
+
 def read_usb_id_from_file(file):
     id = ''
     try:
@@ -1171,11 +1353,11 @@ class KiyoMenu(BaseCtrlMenu):
         self._before = before
 
 class KiyoProCtrls:
-    def __init__(self, device, fd):
+    def __init__(self, device, fd, usb_info, cache):
         self.device = device
         self.fd = fd
-        self.unit_id = find_unit_id_in_sysfs(device, UVC_EU1_GUID)
-        self.usb_ids = find_usb_ids_in_sysfs(device)
+        self.unit_id = usb_info.find_unit_id(UVC_EU1_GUID)
+        self.usb_ids = usb_info.usb_ids
         self.get_device_controls()
 
     def supported(self):
@@ -1390,10 +1572,12 @@ class LogitechCtrl(BaseCtrl):
         self._offset = offset
 
 class LogitechCtrls:
-    def __init__(self, device, fd):
+    def __init__(self, device, fd, usb_info, cache):
         self.device = device
         self.fd = fd
-        self.usb_ids = find_usb_ids_in_sysfs(device)
+        self.cache = cache
+        self.usb_info = usb_info
+        self.usb_ids = usb_info.usb_ids
         self.ctrls = []
 
         self.get_device_controls()
@@ -1401,10 +1585,35 @@ class LogitechCtrls:
     def supported(self):
         return len(self.ctrls) != 0
 
+    # the probes and the ranges are cached, as they are usb transfers
+    def try_xu_control(self, unit_id, selector):
+        key = f'{unit_id}:{selector}'
+        if key not in self.probes:
+            self.probes[key] = try_xu_control(self.fd, unit_id, selector)
+            self.cache_changed = True
+        return self.probes[key]
+
+    def query_xu_range(self, c):
+        if c.text_id not in self.ranges:
+            minimum_config = to_buf(bytes(c._len))
+            query_xu_control(self.fd, c._unit_id, c._selector, UVC_GET_MIN, minimum_config)
+
+            maximum_config = to_buf(bytes(c._len))
+            query_xu_control(self.fd, c._unit_id, c._selector, UVC_GET_MAX, maximum_config)
+
+            self.ranges[c.text_id] = (minimum_config[c._offset][0], maximum_config[c._offset][0])
+            self.cache_changed = True
+        return self.ranges[c.text_id]
+
     def get_device_controls(self):
-        peripheral_unit_id = find_unit_id_in_sysfs(self.device, LOGITECH_PERIPHERAL_GUID)
+        cached = self.cache.get('logitech') if self.cache else None
+        self.probes = dict(cached['probes']) if cached else {}
+        self.ranges = dict(cached['ranges']) if cached else {}
+        self.cache_changed = False
+
+        peripheral_unit_id = self.usb_info.find_unit_id(LOGITECH_PERIPHERAL_GUID)
         if peripheral_unit_id != 0:
-            if try_xu_control(self.fd, peripheral_unit_id, LOGITECH_PERIPHERAL_LED1_SEL):
+            if self.try_xu_control(peripheral_unit_id, LOGITECH_PERIPHERAL_LED1_SEL):
                 self.ctrls.extend([
                     LogitechCtrl(
                         'logitech_led1_mode',
@@ -1433,7 +1642,7 @@ class LogitechCtrls:
                         LOGITECH_PERIPHERAL_LED1_FREQUENCY_OFFSET,
                     ),
                 ])
-            if try_xu_control(self.fd, peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_REL_SEL):
+            if self.try_xu_control(peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_REL_SEL):
                 self.ctrls.extend([
                     LogitechCtrl(
                         'logitech_pan_relative',
@@ -1468,7 +1677,7 @@ class LogitechCtrls:
                         ],
                     ),
                 ])
-            if try_xu_control(self.fd, peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_RESET_SEL):
+            if self.try_xu_control(peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_RESET_SEL):
                 self.ctrls.extend([
                     LogitechCtrl(
                         'logitech_pantilt_reset',
@@ -1486,7 +1695,7 @@ class LogitechCtrls:
                         ],
                     ),
                 ])
-            if try_xu_control(self.fd, peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_PRESET_SEL)\
+            if self.try_xu_control(peripheral_unit_id, LOGITECH_PERIPHERAL_PANTILT_PRESET_SEL)\
                 and self.usb_ids in LOGITECH_PRESET_DEV_MATCH:
                 self.ctrls.extend([
                     LogitechCtrl(
@@ -1520,7 +1729,7 @@ class LogitechCtrls:
                     ),
                 ])
 
-        user_hw_unit_id = find_unit_id_in_sysfs(self.device, LOGITECH_USER_HW_CONTROL_V1_GUID)
+        user_hw_unit_id = self.usb_info.find_unit_id(LOGITECH_USER_HW_CONTROL_V1_GUID)
         if user_hw_unit_id != 0:
             self.ctrls.extend([
                 LogitechCtrl(
@@ -1551,7 +1760,7 @@ class LogitechCtrls:
                 ),
             ])
 
-        motor_control_unit_id = find_unit_id_in_sysfs(self.device, LOGITECH_MOTOR_CONTROL_V1_GUID)
+        motor_control_unit_id = self.usb_info.find_unit_id(LOGITECH_MOTOR_CONTROL_V1_GUID)
         if motor_control_unit_id != 0 and self.usb_ids in LOGITECH_MOTOR_CONTROL_FOCUS_DEV_MATCH:
             self.ctrls.extend([
                 LogitechCtrl(
@@ -1566,7 +1775,7 @@ class LogitechCtrls:
                 ),
             ])
 
-        brio_unit_id = find_unit_id_in_sysfs(self.device, LOGITECH_BRIO_GUID)
+        brio_unit_id = self.usb_info.find_unit_id(LOGITECH_BRIO_GUID)
         if brio_unit_id != 0 and self.usb_ids in LOGITECH_BRIO_FOV_DEV_MATCH:
             self.ctrls.extend([
                 LogitechCtrl(
@@ -1587,13 +1796,7 @@ class LogitechCtrls:
             ])
 
         for c in self.ctrls:
-            minimum_config = to_buf(bytes(c._len))
-            query_xu_control(self.fd, c._unit_id, c._selector, UVC_GET_MIN, minimum_config)
-            c.min = minimum_config[c._offset][0]
-
-            maximum_config = to_buf(bytes(c._len))
-            query_xu_control(self.fd, c._unit_id, c._selector, UVC_GET_MAX, maximum_config)
-            c.max = maximum_config[c._offset][0]
+            c.min, c.max = self.query_xu_range(c)
 
             if c.type == 'button':
                 continue
@@ -1607,6 +1810,8 @@ class LogitechCtrls:
                 if valmenu:
                     c.value = valmenu.text_id
 
+        if self.cache and self.cache_changed:
+            self.cache.set('logitech', {'probes': self.probes, 'ranges': self.ranges})
 
     def setup_ctrls(self, params, errs):
         if not self.supported():
@@ -1689,11 +1894,11 @@ class DellUltraSharpCtrl(BaseCtrl):
         super().__init__(text_id, name, type, tooltip=tooltip, menu=menu)
 
 class DellUltraSharpCtrls:
-    def __init__(self, device, fd):
+    def __init__(self, device, fd, usb_info, cache):
         self.device = device
         self.fd = fd
-        self.unit_id = find_unit_id_in_sysfs(device, DELL_ULTRASHARP_GUID)
-        self.usb_ids = find_usb_ids_in_sysfs(device)
+        self.unit_id = usb_info.find_unit_id(DELL_ULTRASHARP_GUID)
+        self.usb_ids = usb_info.usb_ids
         self.get_device_controls()
 
     def supported(self):
@@ -1874,11 +2079,11 @@ class AnkerWorkCtrl(BaseCtrl):
         self.length = length
 
 class AnkerWorkCtrls:
-    def __init__(self, device, fd):
+    def __init__(self, device, fd, usb_info, cache):
         self.device = device
         self.fd = fd
-        self.unit_id = find_unit_id_in_sysfs(device, ANKERWORK_GUID)
-        self.usb_ids = find_usb_ids_in_sysfs(device)
+        self.unit_id = usb_info.find_unit_id(ANKERWORK_GUID)
+        self.usb_ids = usb_info.usb_ids
         self.get_device_controls()
 
     def supported(self):
@@ -2102,6 +2307,12 @@ class V4L2Ctrl(BaseCtrl):
     def __init__(self, v4l2_id, text_id, name, type, value, default = None, min = None, max = None, step = None, menu = None):
         super().__init__(text_id, name, type, value, default, min, max, step, menu=menu)
         self.v4l2_id = v4l2_id
+        self.v4l2_type = None
+        self.write_only = False
+        self.elems = 1
+        self.dims = []
+        # buffer for the compound, array and string values
+        self.payload = None
         self.last_set = 0
         self.repeat = None
 
@@ -2112,18 +2323,34 @@ class V4L2Ctrls:
         V4L2_CTRL_TYPE_MENU: 'menu',
         V4L2_CTRL_TYPE_INTEGER_MENU: 'menu',
         V4L2_CTRL_TYPE_BUTTON: 'button',
+        V4L2_CTRL_TYPE_INTEGER64: 'integer',
+    }
+    # these are shown as read-only info controls
+    to_elem_type = {
+        V4L2_CTRL_TYPE_INTEGER: ctypes.c_int32,
+        V4L2_CTRL_TYPE_BOOLEAN: ctypes.c_int32,
+        V4L2_CTRL_TYPE_INTEGER64: ctypes.c_int64,
+        V4L2_CTRL_TYPE_U8: ctypes.c_uint8,
+        V4L2_CTRL_TYPE_U16: ctypes.c_uint16,
+        V4L2_CTRL_TYPE_U32: ctypes.c_uint32,
+        V4L2_CTRL_TYPE_AREA: v4l2_area,
     }
     strtrans = bytes.maketrans(b' -', b'__')
 
-    def __init__(self, device, fd):
+    def __init__(self, device, fd, cache = None):
         self.device = device
         self.fd = fd
+        self.cache = cache
+        self.ext_ctrls_supported = True
+        self.query_ext_ctrl_supported = True
         self.get_device_controls()
 
 
     def setup_ctrls(self, params, errs):
+        # collect the values first, then write them with one ioctl per control class
+        batches = {}
         for k, v in params.items():
-            ctrl = find_by_text_id(self.ctrls, k)
+            ctrl = self.ctrls_by_text_id.get(k)
             if ctrl is None:
                 continue
             intvalue = 0
@@ -2151,19 +2378,101 @@ class V4L2Ctrls:
             else:
                 collect_warning(f'V4L2Ctrls: Can\'t set {k} to {v} (Unsupported control type {ctrl.type})', errs)
                 continue
+            ctrl_class = ctrl.v4l2_id & V4L2_CTRL_CLASS_MASK
+            batches.setdefault(ctrl_class, []).append((ctrl, v, intvalue))
+
+        for ctrl_class, batch in batches.items():
+            if self.ext_ctrls_supported and len(batch) > 1:
+                batch = self.set_ext_ctrls(ctrl_class, batch, errs)
+            # fall back to one by one for the rest
+            for ctrl, v, intvalue in batch:
+                self.set_ctrl(ctrl, v, intvalue, errs)
+
+    def to_ext_ctrls(self, ctrl_class, batch):
+        controls = (v4l2_ext_control * len(batch))()
+        for i, (ctrl, v, intvalue) in enumerate(batch):
+            controls[i].id = ctrl.v4l2_id
+            if ctrl.v4l2_type == V4L2_CTRL_TYPE_INTEGER64:
+                controls[i].value64 = intvalue
+            else:
+                controls[i].value = intvalue
+
+        ext_ctrls = v4l2_ext_controls()
+        ext_ctrls.ctrl_class = ctrl_class
+        ext_ctrls.count = len(batch)
+        ext_ctrls.controls = controls
+        return ext_ctrls, controls
+
+    # validates the batch, drops the rejected controls, returns None if it can't tell which one failed
+    def try_ext_ctrls(self, ctrl_class, batch, errs):
+        while batch:
+            ext_ctrls, _ = self.to_ext_ctrls(ctrl_class, batch)
             try:
-                new_ctrl = v4l2_control(ctrl.v4l2_id, intvalue)
-                ioctl(self.fd, VIDIOC_S_CTRL, new_ctrl)
-                if new_ctrl.value != intvalue:
-                    collect_warning(f'V4L2Ctrls: Can\'t set {k} to {v} using {new_ctrl.value}', errs)
-                    continue
+                ioctl(self.fd, VIDIOC_TRY_EXT_CTRLS, ext_ctrls)
+                break
+            except OSError as e:
+                if e.errno == ENOTTY:
+                    raise
+                idx = ext_ctrls.error_idx
+                logging.debug(f'V4L2Ctrls: VIDIOC_TRY_EXT_CTRLS failed at {idx}/{len(batch)}: {e}')
+                if idx >= len(batch):
+                    return None
+                ctrl, v, intvalue = batch[idx]
+                collect_warning(f'V4L2Ctrls: Can\'t set {ctrl.text_id} to {v} ({e})', errs)
+                batch = batch[:idx] + batch[idx+1:]
+        return batch
+
+    # returns the controls which were not set
+    def set_ext_ctrls(self, ctrl_class, batch, errs):
+        try:
+            # validate the whole batch first, so a bad value doesn't leave it half applied
+            tried = self.try_ext_ctrls(ctrl_class, batch, errs)
+        except OSError:
+            logging.info(f'V4L2Ctrls: VIDIOC_S_EXT_CTRLS is not supported, using VIDIOC_S_CTRL')
+            self.ext_ctrls_supported = False
+            return batch
+        if tried is None:
+            return batch
+        batch = tried
+        if not batch:
+            return []
+
+        ext_ctrls, controls = self.to_ext_ctrls(ctrl_class, batch)
+        done = len(batch)
+        try:
+            ioctl(self.fd, VIDIOC_S_EXT_CTRLS, ext_ctrls)
+        except OSError as e:
+            # error_idx == count means the error happened before any control was written
+            done = ext_ctrls.error_idx if ext_ctrls.error_idx < len(batch) else 0
+            logging.debug(f'V4L2Ctrls: VIDIOC_S_EXT_CTRLS failed at {ext_ctrls.error_idx}/{len(batch)}: {e}')
+
+        for i in range(done):
+            ctrl, v, intvalue = batch[i]
+            self.update_set_value(ctrl, v, intvalue, self.get_ext_value(ctrl, controls[i]), errs)
+        return batch[done:]
+
+    def set_ctrl(self, ctrl, v, intvalue, errs):
+        # 64-bit controls can be set only with the extended ioctl
+        if ctrl.v4l2_type == V4L2_CTRL_TYPE_INTEGER64:
+            if self.set_ext_ctrls(ctrl.v4l2_id & V4L2_CTRL_CLASS_MASK, [(ctrl, v, intvalue)], errs):
+                collect_warning(f'V4L2Ctrls: Can\'t set {ctrl.text_id} to {v}', errs)
+            return
+        try:
+            new_ctrl = v4l2_control(ctrl.v4l2_id, intvalue)
+            ioctl(self.fd, VIDIOC_S_CTRL, new_ctrl)
+            self.update_set_value(ctrl, v, intvalue, new_ctrl.value, errs)
+        except Exception as e:
+            collect_warning(f'V4L2Ctrls: Can\'t set {ctrl.text_id} to {v} ({e})', errs)
 
-                if ctrl.type == 'menu':
-                    ctrl.value = v
-                else:
-                    ctrl.value = intvalue
-            except Exception as e:
-                collect_warning(f'V4L2Ctrls: Can\'t set {k} to {v} ({e})', errs)
+    def update_set_value(self, ctrl, v, intvalue, new_value, errs):
+        if new_value != intvalue:
+            collect_warning(f'V4L2Ctrls: Can\'t set {ctrl.text_id} to {v} using {new_value}', errs)
+            return
+
+        if ctrl.type == 'menu':
+            ctrl.value = v
+        else:
+            ctrl.value = intvalue
 
     def set_ctrl_int_value(self, ctrl, intvalue, errs):
         if ctrl.type != 'menu':
@@ -2177,39 +2486,50 @@ class V4L2Ctrls:
 
     def get_device_controls(self):
         ctrls = []
+        to_read = []
+        # the controls are enumerated every time, as the xu mappings can be added at runtime,
+        # but the menu items come from the cache
+        menus = self.cache.get('v4l2_menus') if self.cache else None
+        menus_changed = menus is None
+        if menus is None:
+            menus = {}
         next_flag = V4L2_CTRL_FLAG_NEXT_CTRL | V4L2_CTRL_FLAG_NEXT_COMPOUND
-        qctrl = v4l2_queryctrl(next_flag)
+        qctrl_id = next_flag
         while True:
             try:
-                ioctl(self.fd, VIDIOC_QUERYCTRL, qctrl)
+                qctrl = self.query_ctrl(qctrl_id)
             except OSError as err:
                 if err.errno == EIO:
-                    logging.warning(f'V4L2Ctrls: VIDIOC_QUERYCTL returned EIO for {self.to_text_id(qctrl.name)}. Skipping...')
-                    qctrl = v4l2_queryctrl(qctrl.id + 1 | next_flag)
+                    logging.warning(f'V4L2Ctrls: VIDIOC_QUERYCTL returned EIO after 0x{qctrl_id & ~next_flag:08x}. Skipping...')
+                    qctrl_id = qctrl_id + 1 | next_flag
                     continue
                 else:
                     break
-            if qctrl.type in [V4L2_CTRL_TYPE_INTEGER, V4L2_CTRL_TYPE_BOOLEAN,
-                V4L2_CTRL_TYPE_MENU, V4L2_CTRL_TYPE_INTEGER_MENU, V4L2_CTRL_TYPE_BUTTON]:
+            qctrl_id = qctrl.id | next_flag
 
+            ctrl_type = self.get_ctrl_type(qctrl)
+            if ctrl_type is not None:
                 text_id = self.to_text_id(qctrl.name)
                 text = qctrl.name.decode()
-                ctrl_type = V4L2Ctrls.to_type.get(qctrl.type)
                 if ctrl_type == 'integer' and qctrl.minimum == 0 and qctrl.maximum == 1 and qctrl.step == 1:
                     ctrl_type = 'boolean'
 
-                if ctrl_type != 'button':
-                    try:
-                        ctrl = v4l2_control(qctrl.id)
-                        ioctl(self.fd, VIDIOC_G_CTRL, ctrl)
-                    except:
-                        logging.warning(f'V4L2Ctrls: Can\'t get ctrl {qctrl.name} value')
-
-                    v4l2ctrl = V4L2Ctrl(qctrl.id, text_id, text, ctrl_type, int(ctrl.value),
+                if ctrl_type == 'info':
+                    v4l2ctrl = V4L2Ctrl(qctrl.id, text_id, text, ctrl_type, None)
+                    v4l2ctrl.payload = (ctypes.c_uint8 * (qctrl.elem_size * qctrl.elems))()
+                    to_read.append(v4l2ctrl)
+                elif ctrl_type != 'button':
+                    # the value will be read after the enumeration
+                    v4l2ctrl = V4L2Ctrl(qctrl.id, text_id, text, ctrl_type, None,
                         qctrl.default, qctrl.minimum, qctrl.maximum, qctrl.step)
+                    to_read.append(v4l2ctrl)
                 else:
                     v4l2ctrl = V4L2Ctrl(qctrl.id, text_id, text, ctrl_type, None, menu = [ BaseCtrlMenu(text_id, text, text_id) ])
 
+                v4l2ctrl.v4l2_type = qctrl.type
+                v4l2ctrl.write_only = bool(qctrl.flags & V4L2_CTRL_FLAG_WRITE_ONLY)
+                v4l2ctrl.elems = qctrl.elems
+                v4l2ctrl.dims = list(qctrl.dims[:qctrl.nr_of_dims])
                 v4l2ctrl.inactive = bool(qctrl.flags & V4L2_CTRL_FLAG_INACTIVE)
                 v4l2ctrl.readonly = bool(qctrl.flags & V4L2_CTRL_FLAG_READ_ONLY)
                 ctrl_info = V4L2_CTRL_INFO.get(qctrl.id)
@@ -2236,37 +2556,163 @@ class V4L2Ctrls:
                     v4l2ctrl.scale_class = 'dark-to-light'
 
                 if qctrl.type in [V4L2_CTRL_TYPE_MENU, V4L2_CTRL_TYPE_INTEGER_MENU]:
-                    v4l2ctrl.menu = []
-                    for i in range(qctrl.minimum, qctrl.maximum + 1):
-                        try:
-                            qmenu = v4l2_querymenu(qctrl.id, i)
-                            ioctl(self.fd, VIDIOC_QUERYMENU, qmenu)
-                        except:
-                            continue
-                        if qctrl.type == V4L2_CTRL_TYPE_MENU:
-                            menu_text = qmenu.name.decode()
-                            menu_text_id = self.to_text_id(qmenu.name)
-                        else:
-                            menu_text_id = str(qmenu.value)
-                            menu_text = menu_text_id
-                        v4l2menu = BaseCtrlMenu(menu_text_id, menu_text, int(qmenu.index))
-                        v4l2ctrl.menu.append(v4l2menu)
-                        if v4l2ctrl.value == qmenu.index:
-                            v4l2ctrl.value = menu_text_id
-                        if v4l2ctrl.default == qmenu.index:
-                            v4l2ctrl.default = menu_text_id
-
-                    # when there is no menu item for the value
+                    menu = menus.get(str(qctrl.id))
+                    if menu is None:
+                        menu = self.query_menu(qctrl)
+                        menus[str(qctrl.id)] = menu
+                        menus_changed = True
+                    v4l2ctrl.menu = [BaseCtrlMenu(text_id, text, index) for text_id, text, index in menu]
+
+                    # when there is no menu item for the default
                     # it should be None
-                    if isinstance(v4l2ctrl.value, int):
-                        v4l2ctrl.value = None
-                    if isinstance(v4l2ctrl.default, int):
-                        v4l2ctrl.default = None
+                    defmenu = find_by_value(v4l2ctrl.menu, v4l2ctrl.default)
+                    v4l2ctrl.default = defmenu.text_id if defmenu else None
 
                 ctrls.append(v4l2ctrl)
-            qctrl = v4l2_queryctrl(qctrl.id | next_flag)
 
+        if self.cache and menus_changed:
+            self.cache.set('v4l2_menus', menus)
+
+        self.read_ctrl_values(to_read)
         self.ctrls = ctrls
+        self.ctrls_by_v4l2_id = {c.v4l2_id: c for c in ctrls}
+        self.ctrls_by_text_id = {}
+        for c in ctrls:
+            self.ctrls_by_text_id.setdefault(c.text_id, c)
+
+    def query_menu(self, qctrl):
+        menu = []
+        for i in range(qctrl.minimum, qctrl.maximum + 1):
+            try:
+                qmenu = v4l2_querymenu(qctrl.id, i)
+                ioctl(self.fd, VIDIOC_QUERYMENU, qmenu)
+            except:
+                continue
+            if qctrl.type == V4L2_CTRL_TYPE_MENU:
+                menu_text = qmenu.name.decode()
+                menu_text_id = self.to_text_id(qmenu.name)
+            else:
+                menu_text_id = str(qmenu.value)
+                menu_text = menu_text_id
+            menu.append((menu_text_id, menu_text, int(qmenu.index)))
+        return menu
+
+    def query_ctrl(self, id):
+        if self.query_ext_ctrl_supported:
+            qctrl = v4l2_query_ext_ctrl(id)
+            try:
+                ioctl(self.fd, VIDIOC_QUERY_EXT_CTRL, qctrl)
+                return qctrl
+            except OSError as err:
+                if err.errno != ENOTTY:
+                    raise
+                logging.info(f'V4L2Ctrls: VIDIOC_QUERY_EXT_CTRL is not supported, using VIDIOC_QUERYCTRL')
+                self.query_ext_ctrl_supported = False
+
+        lqctrl = v4l2_queryctrl(id)
+        ioctl(self.fd, VIDIOC_QUERYCTRL, lqctrl)
+        return v4l2_query_ext_ctrl(lqctrl.id, lqctrl.type, lqctrl.name,
+            lqctrl.minimum, lqctrl.maximum, lqctrl.step, lqctrl.default, lqctrl.flags,
+            ctypes.sizeof(ctypes.c_int32), 1, 0)
+
+    def get_ctrl_type(self, qctrl):
+        if qctrl.nr_of_dims == 0 and qctrl.type in V4L2Ctrls.to_type:
+            return V4L2Ctrls.to_type[qctrl.type]
+        # VIDIOC_QUERYCTRL doesn't tell the payload size
+        if not self.query_ext_ctrl_supported:
+            return None
+        if qctrl.type in V4L2Ctrls.to_elem_type or qctrl.type == V4L2_CTRL_TYPE_STRING:
+            return 'info'
+        return None
+
+    def read_ctrl_values(self, ctrls):
+        batches = {}
+        for ctrl in ctrls:
+            if ctrl.write_only:
+                self.read_ctrl_value(ctrl)
+                continue
+            batches.setdefault(ctrl.v4l2_id & V4L2_CTRL_CLASS_MASK, []).append(ctrl)
+
+        for ctrl_class, batch in batches.items():
+            if self.ext_ctrls_supported and len(batch) > 1 and self.get_ext_ctrls(ctrl_class, batch):
+                continue
+            for ctrl in batch:
+                self.read_ctrl_value(ctrl)
+
+    def get_ext_ctrls(self, ctrl_class, batch):
+        controls = (v4l2_ext_control * len(batch))()
+        for i, ctrl in enumerate(batch):
+            controls[i].id = ctrl.v4l2_id
+            if ctrl.payload is not None:
+                controls[i].size = len(ctrl.payload)
+                controls[i].ptr = ctypes.addressof(ctrl.payload)
+
+        ext_ctrls = v4l2_ext_controls()
+        ext_ctrls.ctrl_class = ctrl_class
+        ext_ctrls.count = len(batch)
+        ext_ctrls.controls = controls
+
+        try:
+            ioctl(self.fd, VIDIOC_G_EXT_CTRLS, ext_ctrls)
+        except OSError as e:
+            if e.errno == ENOTTY:
+                logging.info(f'V4L2Ctrls: VIDIOC_G_EXT_CTRLS is not supported, using VIDIOC_G_CTRL')
+                self.ext_ctrls_supported = False
+            else:
+                logging.debug(f'V4L2Ctrls: VIDIOC_G_EXT_CTRLS failed at {ext_ctrls.error_idx}/{len(batch)}: {e}')
+            return False
+
+        for i, ctrl in enumerate(batch):
+            if ctrl.payload is not None:
+                ctrl.value = self.format_payload(ctrl)
+            else:
+                self.set_read_value(ctrl, self.get_ext_value(ctrl, controls[i]))
+        return True
+
+    def get_ext_value(self, ctrl, control):
+        if ctrl.v4l2_type == V4L2_CTRL_TYPE_INTEGER64:
+            return int(control.value64)
+        return int(control.value)
+
+    def format_payload(self, ctrl):
+        if ctrl.v4l2_type == V4L2_CTRL_TYPE_STRING:
+            return bytes(ctrl.payload).split(b'\x00', 1)[0].decode(errors='replace')
+
+        elem_type = V4L2Ctrls.to_elem_type[ctrl.v4l2_type]
+        elems = (elem_type * ctrl.elems).from_buffer(ctrl.payload)
+        if ctrl.v4l2_type == V4L2_CTRL_TYPE_AREA:
+            values = [wh2str(e) for e in elems]
+        else:
+            values = [str(e) for e in elems]
+
+        # show the matrices row by row
+        if len(ctrl.dims) == 2:
+            cols = ctrl.dims[1]
+            return '\n'.join([', '.join(values[r:r + cols]) for r in range(0, len(values), cols)])
+        return ', '.join(values)
+
+    def read_ctrl_value(self, ctrl):
+        # the 64-bit and the compound controls can be read only with the extended ioctl
+        if ctrl.payload is not None or ctrl.v4l2_type == V4L2_CTRL_TYPE_INTEGER64:
+            if not self.get_ext_ctrls(ctrl.v4l2_id & V4L2_CTRL_CLASS_MASK, [ctrl]):
+                logging.warning(f'V4L2Ctrls: Can\'t get ctrl {ctrl.name} value')
+            return
+
+        value = v4l2_control(ctrl.v4l2_id)
+        try:
+            ioctl(self.fd, VIDIOC_G_CTRL, value)
+        except:
+            logging.warning(f'V4L2Ctrls: Can\'t get ctrl {ctrl.name} value')
+        self.set_read_value(ctrl, int(value.value))
+
+    def set_read_value(self, ctrl, intvalue):
+        if ctrl.type != 'menu':
+            ctrl.value = intvalue
+            return
+        # when there is no menu item for the value
+        # it should be None
+        menu = find_by_value(ctrl.menu, intvalue)
+        ctrl.value = menu.text_id if menu is not None else None
 
     def get_ctrls(self):
         return self.ctrls
@@ -2275,13 +2721,46 @@ class V4L2Ctrls:
         return text.lower().translate(V4L2Ctrls.strtrans, delete = b',&(.)/').replace(b'__', b'_').decode()
 
     def find_by_v4l2_id(self, v4l2_id):
-        idx = find_idx(self.ctrls, lambda c: hasattr(c, 'v4l2_id') and c.v4l2_id == v4l2_id)
-        if idx is not None:
-            return self.ctrls[idx]
-        else:
-            None
+        return self.ctrls_by_v4l2_id.get(v4l2_id)
 
 
+def subscribe_ctrl_events(fd, ctrls, errs):
+    sub = v4l2_event_subscription()
+    sub.type = V4L2_EVENT_CTRL
+    sub.flags = V4L2_EVENT_SUB_FL_ALLOW_FEEDBACK
+    for c in ctrls.ctrls:
+        sub.id = c.v4l2_id
+        try:
+            ioctl(fd, VIDIOC_SUBSCRIBE_EVENT, sub)
+        except Exception as e:
+            collect_warning(f'VIDIOC_SUBSCRIBE_EVENT failed: {e}', errs)
+            return False
+    return True
+
+# dequeues a control event and updates the control from it, returns the control
+def dequeue_ctrl_event(fd, ctrls, errs):
+    event = v4l2_event()
+    try:
+        ioctl(fd, VIDIOC_DQEVENT, event)
+    except OSError as e:
+        # no pending event on a non-blocking fd
+        if e.errno not in [EAGAIN, ENOENT]:
+            collect_warning(f'VIDIOC_DQEVENT failed: {e}', errs)
+        return None
+    ctrl = ctrls.find_by_v4l2_id(event.id)
+    if ctrl is None:
+        return None
+    ctrl.inactive = bool(event.ctrl.flags & V4L2_CTRL_FLAG_INACTIVE)
+    ctrl.readonly = bool(event.ctrl.flags & V4L2_CTRL_FLAG_READ_ONLY)
+    if ctrl.payload is not None:
+        ctrls.read_ctrl_value(ctrl)
+    elif ctrl.v4l2_type == V4L2_CTRL_TYPE_INTEGER64:
+        ctrls.set_ctrl_int_value(ctrl, int(event.ctrl.value64), errs)
+    else:
+        ctrls.set_ctrl_int_value(ctrl, int(event.ctrl.value), errs)
+    logging.info(f'VIDIOC_DQEVENT {ctrl.text_id}={ctrl.value} (pending: {event.pending})')
+    return ctrl
+
 class V4L2Listener(Thread):
     def __init__(self, ctrls, fmt_ctrls, cb, err_cb):
         super().__init__()
@@ -2290,20 +2769,16 @@ class V4L2Listener(Thread):
         self.fmt_ctrls = fmt_ctrls
         self.cb = cb
         self.err_cb = err_cb
-        self.epoll = select.epoll() 
+        # stop wakes up the thread through this
+        self.wakeup = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+        self.epoll = select.epoll()
         self.epoll.register(self.fd, select.POLLPRI | select.POLLERR | select.POLLNVAL)
-    
-        sub = v4l2_event_subscription()
-        sub.type = V4L2_EVENT_CTRL
-        sub.flags = V4L2_EVENT_SUB_FL_ALLOW_FEEDBACK
-        for c in self.ctrls.ctrls:
-            sub.id = c.v4l2_id
-            try:
-                ioctl(self.fd, VIDIOC_SUBSCRIBE_EVENT, sub)
-            except Exception as e:
-                self.err_cb(collect_warning(f'VIDIOC_SUBSCRIBE_EVENT failed: {e}', []))
-                self.epoll.close()
-                break
+        self.epoll.register(self.wakeup, select.POLLIN)
+
+        errs = []
+        if not subscribe_ctrl_events(self.fd, self.ctrls, errs):
+            self.err_cb(errs)
+            self.epoll.close()
 
     def update_ctrl(self, ctrl, value, updates):
         if ctrl is not None and ctrl.value != value:
@@ -2327,35 +2802,33 @@ class V4L2Listener(Thread):
 
     # thread start
     def run(self):
-        event = v4l2_event()
         while not self.epoll.closed:
             p = self.epoll.poll(1)
             if len(p) == 0:
-                if not self.epoll.closed:
-                    self.query_fmt_changes()
+                self.query_fmt_changes()
                 continue
+            if any(fd == self.wakeup for (fd, v) in p):
+                break
             (fd , v) = p[0]
             if v == select.POLLNVAL or v == select.POLLERR:
                 break
-            try:
-                ioctl(self.fd, VIDIOC_DQEVENT, event)
-            except Exception as e:
-                self.err_cb(collect_warning(f'VIDIOC_DQEVENT failed: {e}', []))
-                break
-            ctrl = self.ctrls.find_by_v4l2_id(event.id)
-            ctrl.inactive = bool(event.ctrl.flags & V4L2_CTRL_FLAG_INACTIVE)
-            ctrl.readonly = bool(event.ctrl.flags & V4L2_CTRL_FLAG_READ_ONLY)
             errs = []
-            self.ctrls.set_ctrl_int_value(ctrl, int(event.ctrl.value), errs)
-            logging.info(f'VIDIOC_DQEVENT {ctrl.text_id}={ctrl.value} (pending: {event.pending})')
+            ctrl = dequeue_ctrl_event(self.fd, self.ctrls, errs)
             if errs:
                 self.err_cb(errs)
+                if ctrl is None:
+                    break
                 continue
-            self.cb(ctrl)
+            if ctrl is not None:
+                self.cb(ctrl)
 
     # thread stop
     def stop(self):
+        os.eventfd_write(self.wakeup, 1)
+        if self.is_alive():
+            self.join()
         self.epoll.close()
+        os.close(self.wakeup)
 
 
 V4L2_CAP_CARD_DESC = 'Name of the device, a NUL-terminated UTF-8 string. For example: “Yoyodyne TV/FM”. One driver may support different brands or models of video hardware. This information is intended for users, for example in a menu of available devices. Since multiple TV cards of the same brand may be installed which are supported by the same driver, this name should be combined with the character device file name (e. g. /dev/video2) or the bus_info string to avoid ambiguities.'
@@ -2368,6 +2841,7 @@ class V4L2FmtCtrls:
         self.device = device
         self.fd = fd
         self.ctrls = []
+        self.ctrls_by_text_id = {}
         self.pxf_ctrl = None
         self.res_ctrl = None
         self.fps_ctrl = None
@@ -2378,7 +2852,7 @@ class V4L2FmtCtrls:
 
     def setup_ctrls(self, params, errs):
         for k, v in params.items():
-            ctrl = find_by_text_id(self.ctrls, k)
+            ctrl = self.ctrls_by_text_id.get(k)
             if ctrl is None:
                 continue
             if ctrl.type == 'info':
@@ -2436,6 +2910,7 @@ class V4L2FmtCtrls:
                 BaseCtrlMenu(fps, fps, None) for fps in framerates
             ]) # fps menu should be dropdown
             self.ctrls.append(self.fps_ctrl)
+        self.ctrls_by_text_id = {c.text_id: c for c in self.ctrls}
 
     def set_pixelformat(self, ctrl, pixelformat, errs):
         fmt = v4l2_format()
@@ -2875,8 +3350,7 @@ class ConfigPreset:
             collect_warning(f'ConfigPreset: {preset} not found in {filename}', errs)
             return
         
-        for ctrl in config[preset]:
-            self.cam_ctrls.setup_ctrls({ctrl: config[preset][ctrl]}, errs)
+        self.cam_ctrls.setup_ctrls(dict(config[preset]), errs)
 
     def save_preset(self, device, preset_num, errs):
         try:
@@ -2937,6 +3411,78 @@ def get_configfilename(device):
 
     return os.path.join(get_configdir(), f'{dev_id}.ini')
 
+def get_cachedir():
+    return os.path.join(get_configdir(), 'cache')
+
+# the control descriptors of the usb cameras, a firmware update,
+# a descriptor change or a kernel update invalidates them
+class DescriptorCache:
+    def __init__(self, device, usb_info):
+        self.filename = None
+        self.key = None
+        self.sections = {}
+        self.dirty = False
+
+        usb_ids = usb_info.usb_ids
+        if not usb_ids:
+            return
+
+        bcd_device = find_bcd_device_in_sysfs(device)
+        descriptors = hashlib.sha1(usb_info.descriptors).hexdigest()
+        self.key = {
+            'version': version,
+            'kernel': os.uname().release,
+            'bcd_device': bcd_device,
+            'descriptors': descriptors,
+        }
+        # the same model with another firmware gets its own file, they don't overwrite each other
+        index = find_index_in_sysfs(device)
+        self.filename = os.path.join(get_cachedir(), f'{usb_ids.replace(":", "_")}-{bcd_device}-{descriptors[:16]}-{index}.json')
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f'DescriptorCache: failed to load {self.filename}: {e}')
+            return
+
+        if cache.get('key') != self.key:
+            logging.info(f'DescriptorCache: {self.filename} is outdated')
+            self.dirty = True
+            return
+        self.sections = cache.get('sections', {})
+
+    def get(self, section):
+        return self.sections.get(section)
+
+    def set(self, section, value):
+        if self.filename is None:
+            return
+        self.sections[section] = value
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(get_cachedir(), mode=0o755, exist_ok=True)
+            # unique per writer, the cameractrlsd workers may save the same camera model at once
+            fd, tmpfilename = tempfile.mkstemp(dir=os.path.dirname(self.filename), prefix=f'{os.path.basename(self.filename)}.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'key': self.key, 'sections': self.sections}, f)
+                os.replace(tmpfilename, self.filename)
+            except:
+                os.unlink(tmpfilename)
+                raise
+            self.dirty = False
+        except Exception as e:
+            logging.warning(f'DescriptorCache: failed to save {self.filename}: {e}')
+
 def set_repeat_interval(ctrl, e2e_ns):
     if ctrl:
         ctrl.repeat = e2e_ns / ((ctrl.max - ctrl.min) / ctrl.step)
@@ -3116,24 +3662,60 @@ class CtrlCategory:
         self.title = title
         self.ctrls = ctrls
 
+# the vendor providers with the usb ids (None matches every device) and the xu guids they need
+VENDOR_CTRLS = [
+    (KiyoProCtrls, [KIYO_PRO_USB_ID], [UVC_EU1_GUID]),
+    (LogitechCtrls, None, [LOGITECH_PERIPHERAL_GUID, LOGITECH_USER_HW_CONTROL_V1_GUID, LOGITECH_MOTOR_CONTROL_V1_GUID, LOGITECH_BRIO_GUID]),
+    (DellUltraSharpCtrls, DELL_ULTRASHARP_DEV_MATCH, [DELL_ULTRASHARP_GUID]),
+    (AnkerWorkCtrls, ANKERWORK_DEV_MATCH, [ANKERWORK_GUID]),
+]
+
+def get_vendor_ctrls(device, fd, usb_info, cache):
+    ctrls = []
+    if not usb_info.descriptors:
+        return ctrls
+
+    for provider, usb_ids, guids in VENDOR_CTRLS:
+        if usb_ids is not None and usb_info.usb_ids not in usb_ids:
+            continue
+        if not any(usb_info.find_unit_id(guid) != 0 for guid in guids):
+            continue
+        ctrls.append(provider(device, fd, usb_info, cache))
+    return ctrls
+
 class CameraCtrls:
     def __init__(self, device, fd):
         self.device = device
         self.fd = fd
-        self.v4l_ctrls = V4L2Ctrls(device, fd)
+        usb_info = UsbInfo(device)
+        cache = DescriptorCache(device, usb_info)
+        self.v4l_ctrls = V4L2Ctrls(device, fd, cache)
         self.fmt_ctrls = V4L2FmtCtrls(device, fd)
         self.ctrls = [
             self.v4l_ctrls,
             self.fmt_ctrls,
-            KiyoProCtrls(device, fd),
-            LogitechCtrls(device, fd),
-            DellUltraSharpCtrls(device, fd),
-            AnkerWorkCtrls(device, fd),
+            *get_vendor_ctrls(device, fd, usb_info, cache),
             SystemdSaver(self),
             ColorPreset(self),
             ConfigPreset(self),
             DesktopPortal(self),
         ]
+        cache.save()
+
+        # the controls by text_id with their owner providers,
+        # the format ctrls are rebuilt on format changes, so they are looked up in fmt_ctrls
+        self.ctrls_by_text_id = {}
+        for p in self.ctrls:
+            if p is self.fmt_ctrls:
+                continue
+            for c in p.get_ctrls():
+                self.ctrls_by_text_id.setdefault(c.text_id, (p, c))
+
+    def find_ctrl(self, text_id):
+        ctrl = self.fmt_ctrls.ctrls_by_text_id.get(text_id)
+        if ctrl is not None:
+            return (self.fmt_ctrls, ctrl)
+        return self.ctrls_by_text_id.get(text_id)
 
     def has_ptz(self):
         return any([
@@ -3174,9 +3756,18 @@ class CameraCtrls:
 
     def setup_ctrls(self, params, errs):
         logging.debug(f'CameraCtrls.setup_ctrls: {params}')
+        # route the params to their providers, in the order of the providers
+        provider_params = {}
+        unknown_ctrls = []
+        for k, v in params.items():
+            entry = self.find_ctrl(k)
+            if entry is None:
+                unknown_ctrls.append(k)
+                continue
+            provider_params.setdefault(entry[0], {})[k] = v
         for c in self.ctrls:
-            c.setup_ctrls(params, errs)
-        unknown_ctrls = list(set(params.keys()) - set([c.text_id for c in self.get_ctrls()]))
+            if c in provider_params:
+                c.setup_ctrls(provider_params[c], errs)
         if len(unknown_ctrls) > 0:
             collect_warning(f'CameraCtrls: can\'t find {unknown_ctrls} controls', errs)
 
@@ -3187,7 +3778,8 @@ class CameraCtrls:
         return ctrls
 
     def get_ctrl_by_text_id(self, text_id):
-        return find_by_text_id(self.get_ctrls(), text_id)
+        entry = self.find_ctrl(text_id)
+        return entry[1] if entry is not None else None
 
     def get_ctrl_pages(self):
         ctrls = self.get_ctrls()
@@ -3334,20 +3926,22 @@ class CameraCtrls:
 
 
 def usage():
-    print(f'usage: {sys.argv[0]} [--help] [-d DEVICE] [--list] [-c CONTROLS]\n')
+    print(f'usage: {sys.argv[0]} [--help] [-d DEVICE] [--list] [-c CONTROLS] [-s SNAPSHOT] [-b BURST]\n')
     print(f'optional arguments:')
     print(f'  -h, --help         show this help message and exit')
     print(f'  -d DEVICE          use DEVICE, default /dev/video0')
     print(f'  -l, --list         list the controls and values')
     print(f'  -L, --list-devices list capture devices')
     print(f'  -c CONTROLS        set CONTROLS (eg.: hdr=on,fov=wide)')
+    print(f'  -s SNAPSHOT        capture a frame to SNAPSHOT as jpeg, after setting the CONTROLS')
+    print(f'  -b BURST           capture BURST frames to SNAPSHOT as a cameraview recording instead')
     print()
     print(f'example:')
     print(f'  {sys.argv[0]} -c brightness=128,kiyo_pro_hdr=on,kiyo_pro_fov=wide')
 
 def main():
     try:
-        arguments, values = getopt.getopt(sys.argv[1:], 'hd:lLc:', ['help', 'list', 'list-devices'])
+        arguments, values = getopt.getopt(sys.argv[1:], 'hd:lLc:s:b:', ['help', 'list', 'list-devices'])
     except getopt.error as err:
         print(err)
         usage()
@@ -3361,6 +3955,8 @@ def main():
     list_devices = False
     device = '/dev/video0'
     controls = ''
+    snapshot = ''
+    burst = 0
 
     for current_argument, current_value in arguments:
         if current_argument in ('-h', '--help'):
@@ -3374,6 +3970,10 @@ def main():
             list_devices = True
         elif current_argument in ('-c'):
             controls = current_value
+        elif current_argument == '-s':
+            snapshot = current_value
+        elif current_argument == '-b':
+            burst = int(current_value)
 
     if list_devices:
         for d in get_devices(v4ldirs):
@@ -3402,5 +4002,13 @@ def main():
 
         camera_ctrls.setup_ctrls(ctrlsmap, [])
 
+    if snapshot != '':
+        # imported only here, it loads turbojpeg
+        from cameracapture import capture_stills
+        if not capture_stills(device, snapshot, burst):
+            sys.exit(1)
+
 if __name__ == '__main__':
+    # cameracapture imports this module by name, so it isn't loaded twice
+    sys.modules.setdefault('cameractrls', sys.modules[__name__])
     main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
-import sys, os, ctypes, ctypes.util, logging, getopt, time
+import sys, os, ctypes, ctypes.util, logging, getopt
 from collections import namedtuple
 from struct import unpack_from, calcsize
-from cameractrls import CameraCtrls, find_symlink_in, get_configfilename
+from threading import Thread, Lock
+from queue import Queue
+from cameractrls import CameraCtrls, get_configfilename
 
 clib = ctypes.util.find_library('c')
 if clib is None:
@@ -68,19 +70,30 @@ IN_ONESHOT = 0x80000000 # only send event once
 
 NAME_MAX = 255
 
+dev_path = '/dev'
+v4l_path = '/dev/v4l'
+v4l_paths = ['/dev/v4l/by-id', '/dev/v4l/by-path']
+
+# the number of the devices restored in parallel
+PRESET_WORKERS = 4
+
 def usage():
     print(f'usage: {sys.argv[0]} [--help]\n')
     print(f'optional arguments:')
     print(f'  -h, --help         show this help message and exit')
 
+def has_config(device):
+    configfile = get_configfilename(device)
+    if not os.path.exists(configfile):
+        logging.debug(f'has_config: {configfile} does not exists')
+        return False
+    return True
+
 def preset_device(device):
     logging.debug(f'trying to preset_device: {device}')
 
-    configfile = get_configfilename(device)
-
     # if config file does not exists, we should not open the device
-    if not os.path.exists(configfile):
-        logging.debug(f'preset_device: {configfile} does not exists')
+    if not has_config(device):
         return
 
     logging.info(f'preset_device: {device}')
@@ -93,12 +106,51 @@ def preset_device(device):
 
     errs = []
 
-    camera_ctrls = CameraCtrls(device, fd)
-    camera_ctrls.setup_ctrls({'preset': 'load_1'}, errs)
-    if errs:
-        logging.warning(f'preset_device: failed to load_1: {errs}')
-
-    os.close(fd)
+    try:
+        camera_ctrls = CameraCtrls(device, fd)
+        camera_ctrls.setup_ctrls({'preset': 'load_1'}, errs)
+        if errs:
+            logging.warning(f'preset_device: failed to load_1: {errs}')
+    finally:
+        os.close(fd)
+
+# restores the devices on a bounded pool, the events of the same device
+# (by real path) are merged while queued and serialized while restoring
+class PresetScheduler:
+    def __init__(self, workers):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.scheduled = {}
+        self.running = set()
+        for i in range(workers):
+            Thread(target=self.worker, daemon=True).start()
+
+    def schedule(self, device):
+        if not has_config(device):
+            return
+
+        real_path = os.path.realpath(device)
+        with self.lock:
+            queued = real_path in self.scheduled
+            self.scheduled.setdefault(real_path, device)
+            if not queued and real_path not in self.running:
+                self.queue.put(real_path)
+
+    def worker(self):
+        while True:
+            real_path = self.queue.get()
+            with self.lock:
+                device = self.scheduled.pop(real_path)
+                self.running.add(real_path)
+            try:
+                preset_device(device)
+            except Exception as e:
+                logging.warning(f'preset_device({device}) failed: {e}')
+            with self.lock:
+                self.running.discard(real_path)
+                # it came again while restoring
+                if real_path in self.scheduled:
+                    self.queue.put(real_path)
 
 Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'namesize', 'name'])
 EVENT_FMT = 'iIII'
@@ -114,6 +166,39 @@ def parse_events(data):
         events.append(Event(wd, mask, cookie, namesize, name.decode()))
     return events
 
+# udev creates the dirs on demand and removes them when they get empty,
+# so every level is watched, and the new dirs are scanned after adding the watch
+def watch_dir(fd, watches, scheduler, path):
+    if path in watches.values():
+        return
+
+    # udev creates the symlinks with a rename
+    wd = inotify_add_watch(fd, path.encode(), IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+    if wd == -1:
+        logging.debug(f'inotify_add_watch failed {path}')
+        return
+    watches[wd] = path
+
+    try:
+        entries = os.listdir(path)
+    except OSError as e:
+        logging.debug(f'os.listdir({path}) failed: {e}')
+        return
+
+    for entry in entries:
+        handle_entry(fd, watches, scheduler, path, entry)
+
+def handle_entry(fd, watches, scheduler, path, name):
+    entry = os.path.join(path, name)
+    if path == dev_path:
+        if entry == v4l_path:
+            watch_dir(fd, watches, scheduler, entry)
+    elif path == v4l_path:
+        if entry in v4l_paths:
+            watch_dir(fd, watches, scheduler, entry)
+    elif not name.startswith('.'):
+        scheduler.schedule(entry)
+
 def main():
     try:
         arguments, values = getopt.getopt(sys.argv[1:], 'h', ['help'])
@@ -127,35 +212,34 @@ def main():
             usage()
             return 0
 
-    dev_path = '/dev'
-    v4l_paths = ['/dev/v4l/by-id/', '/dev/v4l/by-path/']
-
-    for v4l_path in v4l_paths:
-        for dirpath, dirs, files in os.walk(v4l_path):
-            for device in files:
-                preset_device(os.path.join(v4l_path, device))
-
     fd = inotify_init1(0)
     if fd == -1:
         logging.error(f'inotify_init1 failed')
         return 1
 
-    wd = inotify_add_watch(fd, dev_path.encode(), IN_CREATE)
+    watches = {}
+    wd = inotify_add_watch(fd, dev_path.encode(), IN_CREATE | IN_ONLYDIR)
     if wd == -1:
         logging.error(f'inotify_add_watch failed {dev_path}')
         return 1
+    watches[wd] = dev_path
+
+    scheduler = PresetScheduler(PRESET_WORKERS)
+
+    # watches the existing dirs and restores the already connected devices
+    watch_dir(fd, watches, scheduler, v4l_path)
 
     while True:
-        data = os.read(fd, EVENT_SIZE + NAME_MAX + 1)
+        data = os.read(fd, 64 * (EVENT_SIZE + NAME_MAX + 1))
         for e in parse_events(data):
             logging.debug(f'event: {e}')
-            if e.name.startswith('video'):
-                time.sleep(2) # waiting for udev to create dirs
-                path = find_symlink_in(os.path.join(dev_path, e.name), v4l_paths)
-                if path is None:
-                    logging.warning(f'can\'t find {e.name} in {v4l_paths}')
-                    continue
-                preset_device(path.path)
+            if e.mask & IN_IGNORED:
+                watches.pop(e.wd, None)
+                continue
+            path = watches.get(e.wd)
+            if path is None:
+                continue
+            handle_entry(fd, watches, scheduler, path, e.name)
 
 if __name__ == '__main__':
     sys.exit(main())
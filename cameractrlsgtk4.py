@@ -507,6 +507,10 @@ class CameraCtrlsWindow(Gtk.ApplicationWindow):
     def update_ctrl(self, ctrl, value):
         # only update if out of sync (when new value comes from the gui)
         if ctrl.value != value and not ctrl.inactive:
+            # the running preview holds the format, it switches and reports back, see preview_reconfigured
+            if ctrl.text_id in self.camera.fmt_ctrls.ctrls_by_text_id and \
+                self.get_application().send_to_preview(self.device.path, ctrl.text_id, value):
+                return
             errs = []
             self.camera.setup_ctrls({ctrl.text_id: value}, errs)
             if errs:
@@ -653,6 +657,8 @@ class CameraCtrlsApp(Gtk.Application):
 
         self.window = None
         self.child_processes = []
+        # the running cameraview of the devices
+        self.previews = {}
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
@@ -713,6 +719,7 @@ class CameraCtrlsApp(Gtk.Application):
     def check_preview_open(self, p):
         # if process returned
         if p.poll() is not None:
+            self.previews = {path: preview for path, preview in self.previews.items() if preview is not p}
             (stdout, stderr) = p.communicate()
             errstr = stderr.decode()
             sys.stderr.write(errstr)
@@ -723,12 +730,44 @@ class CameraCtrlsApp(Gtk.Application):
         return True
 
     def open_camera_window(self, action, device):
+        path = device.get_string()
         win_width, win_height = self.window.get_default_size()
-        logging.info(f'open cameraview.py for {device.get_string()} with max size {win_width}x{win_height}')
-        p = subprocess.Popen([f'{sys.path[0]}/cameraview.py', '-d', device.get_string(), '-s', f'{win_width}x{win_height}'], stderr=subprocess.PIPE)
+        logging.info(f'open cameraview.py for {path} with max size {win_width}x{win_height}')
+        p = subprocess.Popen([f'{sys.path[0]}/cameraview.py', '-d', path, '-s', f'{win_width}x{win_height}', '-i'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         self.child_processes.append(p)
+        # a second preview of the device can't open it
+        if path not in self.previews:
+            self.previews[path] = p
+            GLib.io_add_watch(p.stdout, GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN | GLib.IOCondition.HUP, self.preview_reconfigured, path)
         GLib.timeout_add(300, self.check_preview_open, p)
 
+    # the format controls go to the preview while it streams
+    def send_to_preview(self, path, text_id, value):
+        p = self.previews.get(path)
+        if p is None or p.poll() is not None:
+            return False
+        try:
+            p.stdin.write(f'{text_id}={value}\n'.encode())
+            p.stdin.flush()
+        except OSError as e:
+            logging.warning(f'send_to_preview: {e}')
+            return False
+        return True
+
+    # the preview reports its new format, the menus of the device are refreshed
+    def preview_reconfigured(self, source, condition, path):
+        # check_preview_open closed it
+        if source.closed:
+            return False
+        data = os.read(source.fileno(), 4096)
+        if not data:
+            # False removes the watch
+            return False
+        if self.window.device is not None and self.window.device.path == path:
+            self.window.reopen_device()
+        return True
+
     def kill_child_processes(self):
         for proc in self.child_processes:
             proc.kill()
@@ -1,19 +1,16 @@
 #!/usr/bin/env python3
 
-import os, sys, ctypes, ctypes.util, logging, mmap, struct, getopt, select
-from fcntl import ioctl
-from threading import Thread
+import os, sys, ctypes, ctypes.util, logging, getopt, time, json
+from threading import Thread, Lock
 from operator import lt, gt
 
-from cameractrls import CameraCtrls, PTZController
-from cameractrls import v4l2_capability, v4l2_format, v4l2_streamparm, v4l2_requestbuffers, v4l2_buffer
-from cameractrls import VIDIOC_QUERYCAP, VIDIOC_G_FMT, VIDIOC_G_PARM, VIDIOC_S_PARM
-from cameractrls import VIDIOC_REQBUFS, VIDIOC_QUERYBUF, VIDIOC_QBUF, VIDIOC_DQBUF, VIDIOC_STREAMON, VIDIOC_STREAMOFF
-from cameractrls import V4L2_CAP_VIDEO_CAPTURE, V4L2_CAP_STREAMING, V4L2_MEMORY_MMAP, V4L2_BUF_TYPE_VIDEO_CAPTURE
+from cameractrls import CameraCtrls, PTZController, str2pxf, pxf2str
 from cameractrls import V4L2_PIX_FMT_YUYV, V4L2_PIX_FMT_YVYU, V4L2_PIX_FMT_UYVY, V4L2_PIX_FMT_YU12, V4L2_PIX_FMT_YV12
 from cameractrls import V4L2_PIX_FMT_NV12, V4L2_PIX_FMT_NV21, V4L2_PIX_FMT_GREY
 from cameractrls import V4L2_PIX_FMT_RGB565, V4L2_PIX_FMT_RGB24, V4L2_PIX_FMT_BGR24, V4L2_PIX_FMT_RX24
 from cameractrls import V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG
+from cameracapture import V4L2Camera, MJPEGDecoder, Recorder, Snapshot, DmabufExporter, MJPEG_DECODE_WORKERS
+from cameracapture import TJPF_RGB, TJPF_GRAY, TJ_SCALES, tj_scaled, turbojpeg
 
 sdl2lib = ctypes.util.find_library('SDL2-2.0')
 if sdl2lib is None:
@@ -21,11 +18,9 @@ if sdl2lib is None:
     sys.exit(2)
 sdl2 = ctypes.CDLL(sdl2lib)
 
-turbojpeglib = ctypes.util.find_library('turbojpeg')
-if turbojpeglib is None:
+if turbojpeg is None:
     print('libturbojpeg not found, please install the libturbojpeg package!')
     sys.exit(2)
-turbojpeg = ctypes.CDLL(turbojpeglib)
 
 class SDL_PixelFormat(ctypes.Structure):
     _fields_ = [
@@ -51,6 +46,16 @@ class SDL_Rect(ctypes.Structure):
         ('h', ctypes.c_int),
     ]
 
+class SDL_RendererInfo(ctypes.Structure):
+    _fields_ = [
+        ('name', ctypes.c_char_p),
+        ('flags', ctypes.c_uint32),
+        ('num_texture_formats', ctypes.c_uint32),
+        ('texture_formats', ctypes.c_uint32 * 16),
+        ('max_texture_width', ctypes.c_int),
+        ('max_texture_height', ctypes.c_int),
+    ]
+
 SDL_Init = sdl2.SDL_Init
 SDL_Init.restype = ctypes.c_int
 SDL_Init.argtypes = [ctypes.c_uint32]
@@ -71,11 +76,21 @@ SDL_CreateWindow.restype = ctypes.c_void_p
 SDL_CreateWindow.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_uint32]
 # SDL_Window * SDL_CreateWindow(const char *title, int x, int y, int w, int h, Uint32 flags);
 
+SDL_SetWindowTitle = sdl2.SDL_SetWindowTitle
+SDL_SetWindowTitle.restype = None
+SDL_SetWindowTitle.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+# void SDL_SetWindowTitle(SDL_Window * window, const char *title);
+
 SDL_CreateRenderer = sdl2.SDL_CreateRenderer
 SDL_CreateRenderer.restype = ctypes.c_void_p
 SDL_CreateRenderer.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32]
 # SDL_Renderer * SDL_CreateRenderer(SDL_Window * window, int index, Uint32 flags);
 
+SDL_GetRendererInfo = sdl2.SDL_GetRendererInfo
+SDL_GetRendererInfo.restype = ctypes.c_int
+SDL_GetRendererInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(SDL_RendererInfo)]
+# int SDL_GetRendererInfo(SDL_Renderer * renderer, SDL_RendererInfo * info);
+
 SDL_RenderGetLogicalSize = sdl2.SDL_RenderGetLogicalSize
 SDL_RenderGetLogicalSize.restype = None
 SDL_RenderGetLogicalSize.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
@@ -86,6 +101,11 @@ SDL_RenderSetLogicalSize.restype = ctypes.c_int
 SDL_RenderSetLogicalSize.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
 # int SDL_RenderSetLogicalSize(SDL_Renderer * renderer, int w, int h);
 
+SDL_GetRendererOutputSize = sdl2.SDL_GetRendererOutputSize
+SDL_GetRendererOutputSize.restype = ctypes.c_int
+SDL_GetRendererOutputSize.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+#int SDL_GetRendererOutputSize(SDL_Renderer * renderer, int *w, int *h);
+
 SDL_GetWindowSize = sdl2.SDL_GetWindowSize
 SDL_GetWindowSize.restype = None
 SDL_GetWindowSize.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
@@ -106,6 +126,11 @@ SDL_UpdateTexture.restype = ctypes.c_int
 SDL_UpdateTexture.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]
 # int SDL_UpdateTexture(SDL_Texture * texture, const SDL_Rect * rect, const void *pixels, int pitch);
 
+SDL_UpdateYUVTexture = sdl2.SDL_UpdateYUVTexture
+SDL_UpdateYUVTexture.restype = ctypes.c_int
+SDL_UpdateYUVTexture.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+# int SDL_UpdateYUVTexture(SDL_Texture * texture, const SDL_Rect * rect, const Uint8 *Yplane, int Ypitch, const Uint8 *Uplane, int Upitch, const Uint8 *Vplane, int Vpitch);
+
 SDL_RenderClear = sdl2.SDL_RenderClear
 SDL_RenderClear.restype = ctypes.c_int
 SDL_RenderClear.argtypes = [ctypes.c_void_p]
@@ -124,6 +149,26 @@ SDL_CreateRGBSurfaceFrom.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int
 #SDL_Surface* SDL_CreateRGBSurfaceFrom(void *pixels, int width, int height, int depth, int pitch,
 # Uint32 Rmask, Uint32 Gmask, Uint32 Bmask, Uint32 Amask);
 
+SDL_CreateRGBSurfaceWithFormatFrom = sdl2.SDL_CreateRGBSurfaceWithFormatFrom
+SDL_CreateRGBSurfaceWithFormatFrom.restype = ctypes.POINTER(SDL_Surface)
+SDL_CreateRGBSurfaceWithFormatFrom.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_uint32]
+#SDL_Surface* SDL_CreateRGBSurfaceWithFormatFrom(void *pixels, int width, int height, int depth, int pitch, Uint32 format);
+
+SDL_UpperBlit = sdl2.SDL_UpperBlit
+SDL_UpperBlit.restype = ctypes.c_int
+SDL_UpperBlit.argtypes = [ctypes.POINTER(SDL_Surface), ctypes.POINTER(SDL_Rect), ctypes.POINTER(SDL_Surface), ctypes.POINTER(SDL_Rect)]
+#int SDL_UpperBlit(SDL_Surface * src, const SDL_Rect * srcrect, SDL_Surface * dst, SDL_Rect * dstrect);
+
+SDL_LockTexture = sdl2.SDL_LockTexture
+SDL_LockTexture.restype = ctypes.c_int
+SDL_LockTexture.argtypes = [ctypes.c_void_p, ctypes.POINTER(SDL_Rect), ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int)]
+#int SDL_LockTexture(SDL_Texture * texture, const SDL_Rect * rect, void **pixels, int *pitch);
+
+SDL_UnlockTexture = sdl2.SDL_UnlockTexture
+SDL_UnlockTexture.restype = None
+SDL_UnlockTexture.argtypes = [ctypes.c_void_p]
+#void SDL_UnlockTexture(SDL_Texture * texture);
+
 SDL_ConvertPixels = sdl2.SDL_ConvertPixels
 SDL_ConvertPixels.restype = ctypes.c_int
 SDL_ConvertPixels.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_int]
@@ -148,6 +193,11 @@ SDL_DestroyTexture.restype = None
 SDL_DestroyTexture.argtypes = [ctypes.c_void_p]
 #void SDL_DestroyTexture(SDL_Texture * texture);
 
+SDL_FreeSurface = sdl2.SDL_FreeSurface
+SDL_FreeSurface.restype = None
+SDL_FreeSurface.argtypes = [ctypes.POINTER(SDL_Surface)]
+#void SDL_FreeSurface(SDL_Surface * surface);
+
 SDL_RenderPresent = sdl2.SDL_RenderPresent
 SDL_RenderPresent.restype = None
 SDL_RenderPresent.argtypes = [ctypes.c_void_p]
@@ -182,7 +232,9 @@ SDL_ShowSimpleMessageBox.argtypes = [ctypes.c_uint32, ctypes.c_char_p, ctypes.c_
 
 SDL_INIT_VIDEO = 0x00000020
 SDL_QUIT = 0x100
+SDL_WINDOWEVENT = 0x200
 SDL_KEYDOWN = 0x300
+SDL_WINDOWEVENT_SIZE_CHANGED = 6
 SDL_KEYUP = 0x301
 SDL_MOUSEBUTTONUP = 0x402
 SDL_BUTTON_LEFT = 1
@@ -196,16 +248,22 @@ SDLK_7 = ord('7')
 SDLK_8 = ord('8')
 SDLK_c = ord('c')
 SDLK_f = ord('f')
+SDLK_i = ord('i')
 SDLK_m = ord('m')
+SDLK_p = ord('p')
 SDLK_q = ord('q')
 SDLK_r = ord('r')
+SDLK_t = ord('t')
+SDLK_v = ord('v')
 SDLK_w = ord('w')
 SDLK_a = ord('a')
 SDLK_s = ord('s')
 SDLK_d = ord('d')
+SDLK_x = ord('x')
 SDLK_PLUS = ord('+')
 SDLK_MINUS = ord('-')
 SDLK_ESCAPE = 27
+SDLK_SPACE = 32
 SDLK_SCANCODE_MASK = 1<<30
 
 SDLK_HOME = 74 | SDLK_SCANCODE_MASK
@@ -407,6 +465,7 @@ SDL_PIXELFORMAT_IYUV = SDL_FOURCC('I', 'Y', 'U', 'V')
 SDL_PIXELFORMAT_RGB24 = 386930691
 SDL_PIXELFORMAT_BGR24 = 390076419
 SDL_PIXELFORMAT_BGR888 = 374740996 #XBGR8888
+SDL_PIXELFORMAT_RGB888 = 370546692 #XRGB8888
 SDL_PIXELFORMAT_RGB565 = 353701890
 SDL_TEXTUREACCESS_STREAMING = 1
 
@@ -448,6 +507,19 @@ class SDL_MouseButtonEvent(ctypes.Structure):
         ('y', ctypes.c_int32),
     ]
 
+class SDL_WindowEvent(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('timestamp', ctypes.c_uint32),
+        ('windowID', ctypes.c_uint32),
+        ('event', ctypes.c_uint8),
+        ('padding1', ctypes.c_uint8),
+        ('padding2', ctypes.c_uint8),
+        ('padding3', ctypes.c_uint8),
+        ('data1', ctypes.c_int32),
+        ('data2', ctypes.c_int32),
+    ]
+
 class SDL_UserEvent(ctypes.Structure):
     _fields_ = [
         ('type', ctypes.c_uint32),
@@ -462,195 +534,18 @@ class SDL_UserEvent(ctypes.Structure):
 class SDL_Event(ctypes.Union):
     _fields_ = [
         ('type', ctypes.c_uint32),
+        ('window', SDL_WindowEvent),
         ('key', SDL_KeyboardEvent),
         ('button', SDL_MouseButtonEvent),
         ('user', SDL_UserEvent),
         ('padding', (ctypes.c_uint8 * _event_pad_size)),
     ]
 
-tj_init_decompress = turbojpeg.tjInitDecompress
-tj_init_decompress.restype = ctypes.c_void_p
-#tjhandle tjInitDecompress()
-
-tj_decompress = turbojpeg.tjDecompress2
-tj_decompress.argtypes = [ctypes.c_void_p,
-    ctypes.POINTER(ctypes.c_ubyte), ctypes.c_ulong,
-    ctypes.POINTER(ctypes.c_ubyte),
-    ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
-    ctypes.c_int]
-tj_decompress.restype = ctypes.c_int
-#int tjDecompress2(tjhandle handle,
-#                  const unsigned char *jpegBuf, unsigned long jpegSize,
-#                  unsigned char *dstBuf,
-#                  int width, int pitch, int height, int pixelFormat,
-#                  int flags);
-
-tj_get_error_str = turbojpeg.tjGetErrorStr
-tj_get_error_str.restype = ctypes.c_char_p
-#char* tjGetErrorStr()
-
-tj_destroy = turbojpeg.tjDestroy
-tj_destroy.argtypes = [ctypes.c_void_p]
-tj_destroy.restype = ctypes.c_int
-# int tjDestroy(tjhandle handle);
-
-TJPF_RGB = 0
-
-class V4L2Camera(Thread):
-    def __init__(self, device):
-        super().__init__()
-        self.device = device
-        self.width = 0
-        self.height = 0
-        self.pixelformat = 0
-        self.bytesperline = 0
-        self.stopped = False
-        self.pipe = None
-        self.num_cap_bufs = 6
-        self.cap_bufs = []
-
-        try:
-            self.fd = os.open(self.device, os.O_RDWR, 0)
-        except Exception as e:
-            logging.error(f'os.open: {e}')
-            sys.exit(3)
-
-        self.init_device()
-        self.init_buffers()
-
-
-    def init_device(self):
-        cap = v4l2_capability()
-        ioctl(self.fd, VIDIOC_QUERYCAP, cap)
-
-        if not (cap.capabilities & V4L2_CAP_VIDEO_CAPTURE):
-            logging.error(f'{self.device} is not a video capture device')
-            sys.exit(3)
-
-        if not (cap.capabilities & V4L2_CAP_STREAMING):
-            logging.error(f'{self.device} does not support streaming i/o')
-            sys.exit(3)
-    
-        fmt = v4l2_format()
-        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-        ioctl(self.fd, VIDIOC_G_FMT, fmt)
-    
-        parm = v4l2_streamparm()
-        parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-
-        # Razer Kiyo Pro and Microsoft Lifecam HD-3000 need
-        # to set FPS before first streaming
-        ioctl(self.fd, VIDIOC_G_PARM, parm)
-
-        try:
-            ioctl(self.fd, VIDIOC_S_PARM, parm)
-        except Exception as e:
-            logging.error(f'VIDIOC_S_PARM failed {self.device}: {e}')
-            sys.exit(3)
-
-        self.width = fmt.fmt.pix.width
-        self.height = fmt.fmt.pix.height
-        self.pixelformat = fmt.fmt.pix.pixelformat
-        self.bytesperline = fmt.fmt.pix.bytesperline
-
-
-    def init_buffers(self):
-        req = v4l2_requestbuffers()
-
-        req.count = self.num_cap_bufs
-        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-        req.memory = V4L2_MEMORY_MMAP
-
-
-        try:
-            ioctl(self.fd, VIDIOC_REQBUFS, req)
-        except Exception as e:
-            logging.error(f'Video buffer request failed on {self.device}: {e}')
-            sys.exit(3)
-
-        if req.count != self.num_cap_bufs:
-            logging.error(f'Insufficient buffer memory on {self.device}')
-            sys.exit(3)
-
-        for i in range(req.count):
-            buf = v4l2_buffer()
-            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-            buf.memory = req.memory
-            buf.index = i
-
-            ioctl(self.fd, VIDIOC_QUERYBUF, buf)
-
-            if req.memory == V4L2_MEMORY_MMAP:
-                buf.buffer = mmap.mmap(self.fd, buf.length,
-                    flags=mmap.MAP_SHARED | 0x08000, #MAP_POPULATE
-                    prot=mmap.PROT_READ | mmap.PROT_WRITE,
-                    offset=buf.m.offset)
-
-            self.cap_bufs.append(buf)
-
-    def capture_loop(self):
-        try:
-            ioctl(self.fd, VIDIOC_STREAMON, struct.pack('I', V4L2_BUF_TYPE_VIDEO_CAPTURE))
-        except Exception as e:
-            logging.error(f'VIDIOC_STREAMON failed {self.device}: {e}')
-            self.pipe.write_buf(None)
-            return
-
-        for buf in self.cap_bufs:
-            ioctl(self.fd, VIDIOC_QBUF, buf)
-
-        qbuf = v4l2_buffer()
-        qbuf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-        qbuf.memory = self.cap_bufs[0].memory
-
-        poll = select.poll()
-        poll.register(self.fd, select.POLLIN)
-
-        timeout = 0
-
-        while not self.stopped:
-            # DQBUF can block forever, so poll with 1000 ms timeout before
-            # quit after 5s
-            if len(poll.poll(1000)) == 0:
-                logging.warning(f'{self.device}: timeout occured')
-                timeout += 1
-                if timeout == 5:
-                    self.pipe.write_buf(None)
-                    return
-                continue
-
-            try:
-                ioctl(self.fd, VIDIOC_DQBUF, qbuf)
-            except Exception as e:
-                logging.error(f'VIDIOC_DQBUF failed {self.device}: {e}')
-                self.pipe.write_buf(None)
-                return
-
-            buf = self.cap_bufs[qbuf.index]
-            buf.bytesused = qbuf.bytesused
-            buf.timestamp = qbuf.timestamp
-
-            self.pipe.write_buf(buf)
-
-            ioctl(self.fd, VIDIOC_QBUF, buf)
-
-        try:
-            ioctl(self.fd, VIDIOC_STREAMOFF, struct.pack('I', V4L2_BUF_TYPE_VIDEO_CAPTURE))
-        except Exception as e:
-            logging.error(f'VIDIOC_STREAMOFF failed {self.device}: {e}')
-
-    def stop_capturing(self):
-        self.stopped = True
-
-    # thread start
-    def run(self):
-        self.capture_loop()
-    
-    # thread stop
-    def stop(self):
-        self.stop_capturing()
-        self.join()
-
+SUPPORTED_PIXELFORMATS = [
+    V4L2_PIX_FMT_YUYV, V4L2_PIX_FMT_YVYU, V4L2_PIX_FMT_UYVY, V4L2_PIX_FMT_NV12, V4L2_PIX_FMT_NV21,
+    V4L2_PIX_FMT_YU12, V4L2_PIX_FMT_YV12, V4L2_PIX_FMT_RGB565, V4L2_PIX_FMT_RGB24, V4L2_PIX_FMT_BGR24,
+    V4L2_PIX_FMT_RX24, V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG, V4L2_PIX_FMT_GREY,
+]
 
 def V4L2Format2SDL(format):
     if format == V4L2_PIX_FMT_YUYV:
@@ -686,15 +581,84 @@ def V4L2Format2SDL(format):
     SDL_ShowSimpleMessageBox(SDL_MESSAGEBOX_ERROR, b'Invalid pixel format', formats.encode(), None)
     sys.exit(3)
 
+# a frame owned by the renderer until release is called
+class Frame():
+    def __init__(self, ptr, release, captured, luma=False, scale=1, planes=None):
+        self.ptr = ptr
+        self.release = release
+        self.captured = captured
+        # the decoder may scale it down
+        self.scale = scale
+        # only the luma plane, with the pitch of the width
+        self.luma = luma
+        # the IYUV planes of the decoder as (ptr, pitch) * 3
+        self.planes = planes
+
+# holds only the newest frame for the renderer, the older ones are dropped
+class FrameMailbox():
+    def __init__(self):
+        self.lock = Lock()
+        self.frame = None
+        self.dropped = 0
+
+    # returns True when the renderer has to be woken up
+    def publish(self, frame):
+        with self.lock:
+            old = self.frame
+            self.frame = frame
+            if old is not None:
+                self.dropped += 1
+        if old is not None:
+            old.release()
+        return old is None
+
+    def take(self):
+        with self.lock:
+            frame = self.frame
+            self.frame = None
+        return frame
+
+    def clear(self):
+        frame = self.take()
+        if frame is not None:
+            frame.release()
+
+# gives the luma of the frames as the palette indices of the colormaps,
+# the planar formats are used in place, the packed ones are copied with strides
+class LumaExtractor():
+    def __init__(self, pixelformat, width, height, bytesperline):
+        self.pixelformat = pixelformat
+        self.width = width
+        self.height = height
+        self.bytesperline = bytesperline
+        self.buffer = None
+
+        if pixelformat in [V4L2_PIX_FMT_GREY, V4L2_PIX_FMT_NV12, V4L2_PIX_FMT_NV21, V4L2_PIX_FMT_YU12, V4L2_PIX_FMT_YV12]:
+            self.extract = self.extract_plane
+        else:
+            # SDL converts the packed yuv and the rgb formats with integer math, only its Y plane is used,
+            # for YUYV it's still ~2x faster than picking the luma with the stepped slicing of bytes
+            self.buffer = (ctypes.c_uint8 * (width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)))()
+            self.extract = self.extract_converted
+
+    # returns the pointer and the pitch of the luma
+    def extract_plane(self, ptr):
+        return ptr, self.bytesperline
+
+    def extract_converted(self, ptr):
+        if SDL_ConvertPixels(self.width, self.height, V4L2Format2SDL(self.pixelformat), ptr, self.bytesperline, SDL_PIXELFORMAT_NV12, self.buffer, self.width) != 0:
+            logging.warning(f'SDL_ConvertPixels failed: {SDL_GetError()}')
+        return ctypes.cast(self.buffer, ctypes.c_void_p), self.width
+
 class SDLCameraWindow():
-    def __init__(self, device, win_width, win_height, angle, flip, colormap):
+    def __init__(self, device, win_width, win_height, angle, flip, colormap, ring_depth, burst_frames):
         self.returncode = 0
-        self.cam = V4L2Camera(device)
+        self.cam = V4L2Camera(device, ring_depth)
         self.cam.pipe = self
         self.ctrls = CameraCtrls(device, self.cam.fd)
         self.ptz = PTZController(self.ctrls)
-        width = self.cam.width
-        height = self.cam.height
+        # the ptz keys step from the current values, also when other apps change them
+        self.cam.listen_ctrls(self.ctrls.v4l_ctrls)
 
         rwidth = self.cam.width
         rheight = self.cam.height
@@ -706,22 +670,36 @@ class SDLCameraWindow():
         win_height = rheight if win_height == 0 else min(int(win_width * (rheight/rwidth)), win_height, rheight)
 
         self.fullscreen = False
-        self.tj = None
-        self.outbuffer = None
+        self.show_stats = False
+        self.stats_shown = 0
+        self.decoder = None
+        self.mjpeg_decoder = None
+        self.recorder = None
+        self.exporter = None
+        # the format params read by read_format_requests, applied on the SDL thread
+        self.format_requests = {}
+        self.format_lock = Lock()
+        self.report_format = False
+        self.burst_frames = burst_frames
+        # the next frame is written here, on the capture thread
+        self.snapshot_file = None
+        self.mailbox = FrameMailbox()
         self.bytesperline = self.cam.bytesperline
+        self.luma = None
+        self.frame_scale = 1
+        self.frame_width = 0
+        self.frame_height = 0
+        self.texture = None
+        self.yuv_texture = None
         self.surface = None
-        self.surfbuffer = None
+        self.grey_texture = None
+        self.grey_surface = None
 
         self.angle = 0
         self.flip = 0
         self.dstrect = None
-        self.colormap = None
-
-        if self.cam.pixelformat in [V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG]:
-            self.tj = tj_init_decompress()
-            # create rgb buffer
-            self.outbuffer = (ctypes.c_uint8 * (width * height * 3))()
-            self.bytesperline = width * 3
+        self.colormap = colormap
+        self.colormaps = SDL_PALS
 
         if SDL_Init(SDL_INIT_VIDEO) != 0:
             logging.error(f'SDL_Init failed: {SDL_GetError()}')
@@ -729,18 +707,18 @@ class SDLCameraWindow():
 
         # create a new sdl user event type for new image events
         self.sdl_new_image_event = SDL_RegisterEvents(1)
-        self.sdl_new_grey_image_event = SDL_RegisterEvents(1)
         self.sdl_camera_error_event = SDL_RegisterEvents(1)
+        self.sdl_reconfigure_event = SDL_RegisterEvents(1)
 
         self.new_image_event = SDL_Event()
         self.new_image_event.type = self.sdl_new_image_event
 
-        self.new_grey_image_event = SDL_Event()
-        self.new_grey_image_event.type = self.sdl_new_grey_image_event
-
         self.camera_error_event = SDL_Event()
         self.camera_error_event.type = self.sdl_camera_error_event
 
+        self.reconfigure_event = SDL_Event()
+        self.reconfigure_event.type = self.sdl_reconfigure_event
+
         self.window = SDL_CreateWindow(device.encode(), SDL_WINDOWPOS_UNDEFINED, SDL_WINDOWPOS_UNDEFINED, win_width, win_height, SDL_WINDOW_RESIZABLE | SDL_WINDOW_ALLOW_HIGHDPI)
         if self.window is None:
             logging.error(f'SDL_CreateWindow failed: {SDL_GetError()}')
@@ -749,50 +727,279 @@ class SDLCameraWindow():
         if self.renderer is None:
             logging.error(f'SDL_CreateRenderer failed: {SDL_GetError()}')
             sys.exit(1)
+        # the software renderers convert the yuv textures to rgb anyway
+        self.yuv_decode = self.renderer_supports(SDL_PIXELFORMAT_IYUV)
+
+        if not self.setup_stream():
+            sys.exit(1)
 
         self.rotate(angle)
         self.mirror(flip)
 
+    # (re)creates everything that depends on the format of the camera,
+    # the window, the renderer and the decoder threads are kept
+    def setup_stream(self):
+        width = self.cam.width
+        height = self.cam.height
+
+        self.decoder = None
+        self.bytesperline = self.cam.bytesperline
+        if self.cam.pixelformat in [V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG]:
+            if self.mjpeg_decoder is None:
+                self.mjpeg_decoder = MJPEGDecoder(width, height, MJPEG_DECODE_WORKERS, self.cam.queue_buf, self.write_decoded)
+            elif (self.mjpeg_decoder.width, self.mjpeg_decoder.height) != (width, height):
+                self.mjpeg_decoder.resize(width, height)
+            self.decoder = self.mjpeg_decoder
+            self.decoder.yuv = self.yuv_decode
+
+        self.luma = LumaExtractor(self.cam.pixelformat, width, height, self.bytesperline)
+
+        self.colormaps = SDL_PALS
+        if self.cam.pixelformat == V4L2_PIX_FMT_GREY:
+            self.colormaps = {k: v for k, v in self.colormaps.items() if k != 'grayscale'}
+
+        return self.create_textures(self.decoder.scale if self.decoder is not None else 1)
+
+    def renderer_supports(self, pixelformat):
+        info = SDL_RendererInfo()
+        if SDL_GetRendererInfo(self.renderer, ctypes.byref(info)) != 0:
+            logging.warning(f'SDL_GetRendererInfo failed: {SDL_GetError()}')
+            return False
+        return pixelformat in info.texture_formats[:info.num_texture_formats]
+
+    # the textures and the palette surface are in the size of the (scaled) frames
+    def create_textures(self, scale):
+        self.frame_scale = scale
+        self.frame_width = width = tj_scaled(self.cam.width, scale)
+        self.frame_height = height = tj_scaled(self.cam.height, scale)
+        if self.decoder is not None:
+            self.bytesperline = width * 3
+
+        if self.texture is not None:
+            SDL_DestroyTexture(self.texture)
+            self.texture = None
+        if self.yuv_texture is not None:
+            SDL_DestroyTexture(self.yuv_texture)
+            self.yuv_texture = None
+        if self.grey_texture is not None:
+            SDL_DestroyTexture(self.grey_texture)
+            self.grey_texture = None
+        if self.grey_surface is not None:
+            SDL_FreeSurface(self.grey_surface)
+            self.grey_surface = None
+        if self.surface is not None:
+            SDL_FreeSurface(self.surface)
+            self.surface = None
+
         if self.cam.pixelformat != V4L2_PIX_FMT_GREY:
             self.texture = SDL_CreateTexture(self.renderer, V4L2Format2SDL(self.cam.pixelformat), SDL_TEXTUREACCESS_STREAMING, width, height)
             if self.texture is None:
                 logging.error(f'SDL_CreateTexture failed: {SDL_GetError()}')
-                sys.exit(1)
+                return False
+
+        if self.decoder is not None and self.decoder.yuv:
+            self.yuv_texture = SDL_CreateTexture(self.renderer, SDL_PIXELFORMAT_IYUV, SDL_TEXTUREACCESS_STREAMING, width, height)
+            if self.yuv_texture is None:
+                logging.error(f'SDL_CreateTexture failed: {SDL_GetError()}')
+                return False
 
-        self.surface = SDL_CreateRGBSurfaceFrom(self.surfbuffer, self.cam.width, self.cam.height, 8, self.cam.width, 0, 0, 0, 0)
+        self.surface = SDL_CreateRGBSurfaceFrom(None, width, height, 8, width, 0, 0, 0, 0)
         if not bool(self.surface):
             logging.error(f'SDL_CreateRGBSurfaceFrom failed: {SDL_GetError()}')
-            sys.exit(1)
+            self.surface = None
+            return False
 
-        self.colormaps = SDL_PALS
-        if self.cam.pixelformat == V4L2_PIX_FMT_GREY:
-            self.colormaps = {k: v for k, v in self.colormaps.items() if k != 'grayscale'}
+        self.set_colormap(self.colormap)
+        return True
+
+    # the largest turbojpeg scale which still covers the drawable size
+    def pick_scale(self):
+        if self.decoder is None:
+            return
+
+        out_w = ctypes.c_int()
+        out_h = ctypes.c_int()
+        if SDL_GetRendererOutputSize(self.renderer, ctypes.byref(out_w), ctypes.byref(out_h)) != 0:
+            logging.warning(f'SDL_GetRendererOutputSize failed: {SDL_GetError()}')
+            return
+
+        rwidth, rheight = self.cam.width, self.cam.height
+        if self.angle % 180 != 0:
+            rwidth, rheight = rheight, rwidth
+        shown = min(out_w.value / rwidth, out_h.value / rheight)
+
+        scale = next((s for s in TJ_SCALES if shown <= 1 / s), 1)
+        if scale != self.decoder.scale:
+            logging.info(f'pick_scale: decoding at 1/{scale}')
+            self.decoder.scale = scale
+
+    # switches the format in place, params are the V4L2FmtCtrls params
+    # (pixelformat, resolution, fps)
+    def reconfigure(self, params):
+        start = time.monotonic()
+
+        # the recording has the format in its header
+        if self.recorder is not None:
+            self.stop_recording()
+        # the buffers of the client are freed, it connects again for the new ones
+        if self.exporter is not None:
+            self.exporter.disconnect()
+
+        self.cam.call_sync(self.cam.stream_off)
+        # the frames in flight give back their buffers
+        if self.decoder is not None:
+            self.decoder.drain()
+        self.mailbox.clear()
+
+        errs = []
+        fmt_ctrls = self.ctrls.fmt_ctrls
+        if not self.cam.call_sync(lambda: self.cam.set_format(fmt_ctrls, params, errs)):
+            SDL_PushEvent(ctypes.byref(self.camera_error_event))
+            return
+        if errs:
+            logging.warning(f'reconfigure: {errs}')
+        fmt_ctrls.get_format_ctrls()
 
-        self.set_colormap(colormap)
+        if not self.setup_stream():
+            SDL_PushEvent(ctypes.byref(self.camera_error_event))
+            return
+        self.rotate(0)
+
+        if not self.cam.call_sync(self.cam.stream_on):
+            SDL_PushEvent(ctypes.byref(self.camera_error_event))
+            return
+
+        logging.info(f'reconfigure: {pxf2str(self.cam.pixelformat)} {self.cam.width}x{self.cam.height} {self.cam.fps:g} fps in {(time.monotonic() - start) * 1000:.0f} ms')
+        if self.report_format:
+            print(f'pixelformat={pxf2str(self.cam.pixelformat)} resolution={self.cam.width}x{self.cam.height} fps={self.cam.fps:g}', flush=True)
+
+    # the GUI sends its format changes as pixelformat=VALUE, resolution=VALUE or fps=VALUE lines,
+    # the new format is reported on stdout, so it can refresh its menus
+    def start_format_requests(self, stream):
+        self.report_format = True
+        Thread(target=self.read_format_requests, args=(stream,), daemon=True).start()
+
+    def read_format_requests(self, stream):
+        for line in stream:
+            text_id, _, value = line.strip().partition('=')
+            if text_id not in ['pixelformat', 'resolution', 'fps'] or not value:
+                logging.warning(f'read_format_requests: invalid request: {line.strip()}')
+                continue
+            with self.format_lock:
+                self.format_requests[text_id] = value
+            SDL_PushEvent(ctypes.byref(self.reconfigure_event))
+
+    def apply_format_requests(self):
+        with self.format_lock:
+            params = self.format_requests
+            self.format_requests = {}
+        if params:
+            self.reconfigure(params)
+
+    # steps the pixelformat, resolution or fps menu of the V4L2FmtCtrls
+    def step_format(self, text_id, step):
+        ctrl = self.ctrls.fmt_ctrls.get_ctrls()
+        ctrl = next((c for c in ctrl if c.text_id == text_id), None)
+        if ctrl is None or not ctrl.menu:
+            return
+        values = [m.text_id for m in ctrl.menu]
+        if text_id == 'pixelformat':
+            values = [v for v in values if str2pxf(v) in SUPPORTED_PIXELFORMATS]
+        if ctrl.value not in values:
+            return
+        value = values[(values.index(ctrl.value) + step) % len(values)]
+        if value != ctrl.value:
+            self.reconfigure({text_id: value})
 
     def write_buf(self, buf):
         if buf is None:
             SDL_PushEvent(ctypes.byref(self.camera_error_event))
             return
 
+        if self.recorder is not None:
+            self.recorder.write_buf(buf)
+
+        if self.exporter is not None:
+            self.exporter.write_buf(buf)
+
+        if self.snapshot_file is not None:
+            Snapshot(self.cam, buf, self.snapshot_file).start()
+            self.snapshot_file = None
+
+        if self.decoder is not None:
+            self.decoder.submit(buf)
+            return
+
+        # the buffer is requeued when the frame is rendered or dropped
         ptr = (ctypes.c_uint8 * buf.bytesused).from_buffer(buf.buffer)
-        event = self.new_image_event if self.cam.pixelformat != V4L2_PIX_FMT_GREY else self.new_grey_image_event
-
-        if self.cam.pixelformat == V4L2_PIX_FMT_MJPEG or self.cam.pixelformat == V4L2_PIX_FMT_JPEG:
-            tj_decompress(self.tj, ptr, buf.bytesused, self.outbuffer, self.cam.width, self.bytesperline, self.cam.height, TJPF_RGB, 0)
-            # ignore decode errors, some cameras only send imperfect frames
-            ptr = self.outbuffer
-
-        if self.cam.pixelformat != V4L2_PIX_FMT_GREY and self.colormap != 'none':
-            if self.surfbuffer is None:
-                # create surface buffer as NV12, but use only the Y
-                self.surfbuffer = (ctypes.c_uint8 * (self.cam.width * self.cam.height * 2))()
-            SDL_ConvertPixels(self.cam.width, self.cam.height, V4L2Format2SDL(self.cam.pixelformat), ptr, self.bytesperline, SDL_PIXELFORMAT_NV12, self.surfbuffer, self.cam.width)
-            ptr = self.surfbuffer
-            event = self.new_grey_image_event
-
-        event.user.data1 = ctypes.cast(ptr, ctypes.c_void_p)
-        if SDL_PushEvent(ctypes.byref(event)) < 0:
+        self.push_frame(Frame(ctypes.cast(ptr, ctypes.c_void_p), lambda: self.cam.queue_buf(buf), buf.captured))
+
+    # called by the decoder in the order of the frames
+    def write_decoded(self, idx, pixelformat, captured, scale, planes):
+        self.push_frame(Frame(ctypes.cast(self.decoder.outbuffers[idx], ctypes.c_void_p), lambda: self.decoder.release(idx), captured, pixelformat == TJPF_GRAY, scale, planes))
+
+    # with limit it records a burst of frames
+    def start_recording(self, filename, limit=0):
+        # a finished burst
+        if self.recorder is not None:
+            self.stop_recording()
+
+        try:
+            recorder = Recorder(self.cam, filename, limit)
+        except OSError as e:
+            logging.warning(f'start_recording: {e}')
+            return
+        recorder.start()
+        logging.info(f'recording to {filename}')
+        self.recorder = recorder
+
+    def stop_recording(self):
+        recorder = self.recorder
+        # detached on the capture thread, so no frame comes after the stop
+        def detach():
+            self.recorder = None
+        self.cam.call_sync(detach)
+        self.recorder = None
+        recorder.stop()
+
+    # shares the capture buffers with another process on a unix socket
+    def start_exporting(self, path):
+        try:
+            exporter = DmabufExporter(self.cam, path)
+        except OSError as e:
+            logging.warning(f'start_exporting: {e}')
+            return
+        exporter.start()
+        logging.info(f'exporting the frames on {path}')
+        self.exporter = exporter
+
+    def stop_exporting(self):
+        exporter = self.exporter
+        def detach():
+            self.exporter = None
+        self.cam.call_sync(detach)
+        self.exporter = None
+        exporter.stop()
+
+    def toggle_recording(self):
+        if self.recorder is not None and self.recorder.is_alive():
+            self.stop_recording()
+        else:
+            self.start_recording(output_filename('.v4l2rec'))
+
+    def take_snapshot(self):
+        self.snapshot_file = output_filename('.jpg')
+
+    def take_burst(self):
+        if self.recorder is not None and self.recorder.is_alive():
+            logging.warning('take_burst: already recording')
+            return
+        self.start_recording(output_filename('-burst.v4l2rec'), self.burst_frames)
+
+    def push_frame(self, frame):
+        if not self.mailbox.publish(frame):
+            return
+        if SDL_PushEvent(ctypes.byref(self.new_image_event)) < 0:
             logging.warning(f'SDL_PushEvent failed: {SDL_GetError()}')
 
     def event_loop(self):
@@ -814,30 +1021,55 @@ class SDLCameraWindow():
                     self.mirror(1 if not shift else -1)
                 elif event.key.keysym.sym == SDLK_c:
                     self.step_colormap(1 if not shift else -1)
+                elif event.key.keysym.sym == SDLK_i:
+                    self.toggle_stats()
+                elif event.key.keysym.sym == SDLK_p:
+                    self.step_format('pixelformat', 1 if not shift else -1)
+                elif event.key.keysym.sym == SDLK_x:
+                    self.step_format('resolution', 1 if not shift else -1)
+                elif event.key.keysym.sym == SDLK_t:
+                    self.step_format('fps', 1 if not shift else -1)
+                elif event.key.keysym.sym == SDLK_v:
+                    self.toggle_recording()
+                elif event.key.keysym.sym == SDLK_SPACE:
+                    if not shift:
+                        self.take_snapshot()
+                    else:
+                        self.take_burst()
             elif event.type == SDL_MOUSEBUTTONUP and \
                 event.button.button == SDL_BUTTON_LEFT and \
                 event.button.clicks == 2:
                     self.toggle_fullscreen()
+            elif event.type == SDL_WINDOWEVENT and event.window.event == SDL_WINDOWEVENT_SIZE_CHANGED:
+                self.pick_scale()
             elif event.type == self.sdl_new_image_event:
-                if SDL_UpdateTexture(self.texture, None, event.user.data1, self.bytesperline) != 0:
-                    logging.warning(f'SDL_UpdateTexture failed: {SDL_GetError()}')
-                if SDL_RenderClear(self.renderer) != 0:
-                    logging.warning(f'SDL_RenderClear failed: {SDL_GetError()}')
-                if SDL_RenderCopyEx(self.renderer, self.texture, None, self.dstrect, self.angle, None, self.flip) != 0:
-                    logging.warning(f'SDL_RenderCopy failed: {SDL_GetError()}')
-                SDL_RenderPresent(self.renderer)
-            elif event.type == self.sdl_new_grey_image_event:
-                self.surface[0].pixels = event.user.data1
-                texture = SDL_CreateTextureFromSurface(self.renderer, self.surface)
-                if texture is None:
-                    logging.warning(f'SDL_CreateTextureFromSurface failed: {SDL_GetError()}')
-                    return
-                if SDL_RenderClear(self.renderer) != 0:
-                    logging.warning(f'SDL_RenderClear failed: {SDL_GetError()}')
-                if SDL_RenderCopyEx(self.renderer, texture, None, self.dstrect, self.angle, None, self.flip) != 0:
-                    logging.warning(f'SDL_RenderCopy failed: {SDL_GetError()}')
-                SDL_RenderPresent(self.renderer)
-                SDL_DestroyTexture(texture)
+                frame = self.mailbox.take()
+                if frame is None:
+                    continue
+                if frame.scale != self.frame_scale and not self.create_textures(frame.scale):
+                    frame.release()
+                    SDL_PushEvent(ctypes.byref(self.camera_error_event))
+                    continue
+                if frame.luma:
+                    self.render_grey(frame.ptr, self.frame_width)
+                elif frame.planes is not None and self.colormap != 'none':
+                    # the y plane is the luma
+                    self.render_grey(frame.planes[0], frame.planes[1])
+                elif frame.planes is not None:
+                    self.render_yuv(frame.planes)
+                elif self.decoder is not None and self.colormap != 'none':
+                    # decoded in color before the colormap was set
+                    pass
+                elif self.cam.pixelformat == V4L2_PIX_FMT_GREY or self.colormap != 'none':
+                    self.render_grey(*self.luma.extract(frame.ptr))
+                else:
+                    self.render_image(frame.ptr)
+                self.cam.stats.present(frame.captured)
+                frame.release()
+                if self.show_stats:
+                    self.update_stats()
+            elif event.type == self.sdl_reconfigure_event:
+                self.apply_format_requests()
             elif event.type == self.sdl_camera_error_event:
                 self.stop_capturing()
                 self.returncode = 4
@@ -911,6 +1143,92 @@ class SDLCameraWindow():
                     if event.key.keysym.sym in [SDLK_DOWN, SDLK_KP_2, SDLK_KP_1, SDLK_KP_3, SDLK_s]:
                         self.ptz.do_tilt_speed(0, [])
 
+    def render_image(self, ptr):
+        if SDL_UpdateTexture(self.texture, None, ptr, self.bytesperline) != 0:
+            logging.warning(f'SDL_UpdateTexture failed: {SDL_GetError()}')
+        self.render_texture(self.texture)
+
+    def render_yuv(self, planes):
+        if SDL_UpdateYUVTexture(self.yuv_texture, None, *planes) != 0:
+            logging.warning(f'SDL_UpdateYUVTexture failed: {SDL_GetError()}')
+        self.render_texture(self.yuv_texture)
+
+    # the palette is applied by blitting the indexed surface into the locked texture,
+    # SDL maps the palette to the texture format once, not per pixel or per frame
+    def render_grey(self, ptr, pitch):
+        if self.grey_texture is None:
+            self.grey_texture = SDL_CreateTexture(self.renderer, SDL_PIXELFORMAT_RGB888, SDL_TEXTUREACCESS_STREAMING, self.frame_width, self.frame_height)
+            if self.grey_texture is None:
+                logging.warning(f'SDL_CreateTexture failed: {SDL_GetError()}')
+                return
+
+        pixels = ctypes.c_void_p()
+        tex_pitch = ctypes.c_int()
+        if SDL_LockTexture(self.grey_texture, None, ctypes.byref(pixels), ctypes.byref(tex_pitch)) != 0:
+            logging.warning(f'SDL_LockTexture failed: {SDL_GetError()}')
+            return
+
+        if self.grey_surface is None or self.grey_surface[0].pitch != tex_pitch.value:
+            self.grey_surface = SDL_CreateRGBSurfaceWithFormatFrom(pixels, self.frame_width, self.frame_height, 32, tex_pitch, SDL_PIXELFORMAT_RGB888)
+            if not bool(self.grey_surface):
+                logging.warning(f'SDL_CreateRGBSurfaceWithFormatFrom failed: {SDL_GetError()}')
+                self.grey_surface = None
+                SDL_UnlockTexture(self.grey_texture)
+                return
+        self.grey_surface[0].pixels = pixels
+
+        self.surface[0].pixels = ptr
+        self.surface[0].pitch = pitch
+        if SDL_UpperBlit(self.surface, None, self.grey_surface, None) != 0:
+            logging.warning(f'SDL_UpperBlit failed: {SDL_GetError()}')
+        SDL_UnlockTexture(self.grey_texture)
+
+        self.render_texture(self.grey_texture)
+
+    def render_texture(self, texture):
+        if SDL_RenderClear(self.renderer) != 0:
+            logging.warning(f'SDL_RenderClear failed: {SDL_GetError()}')
+        if SDL_RenderCopyEx(self.renderer, texture, None, self.dstrect, self.angle, None, self.flip) != 0:
+            logging.warning(f'SDL_RenderCopy failed: {SDL_GetError()}')
+        SDL_RenderPresent(self.renderer)
+
+    def toggle_stats(self):
+        self.show_stats = not self.show_stats
+        self.stats_shown = 0
+        if not self.show_stats:
+            SDL_SetWindowTitle(self.window, self.cam.device.encode())
+
+    def stats(self):
+        stats = self.cam.stats.summary()
+        stats['renderer_drops'] = self.mailbox.dropped
+        return stats
+
+    # SDL can't draw text, the stats are shown in the title, once a second
+    def update_stats(self):
+        now = time.monotonic()
+        if now - self.stats_shown < 1:
+            return
+        self.stats_shown = now
+
+        s = self.stats()
+        jitter = s['jitter_ms']['p95'] if s['jitter_ms'] else 0
+        latency = s['latency_ms']['p95'] if s['latency_ms'] else 0
+        title = f'{self.cam.device} {s["fps"]:.1f}/{s["nominal_fps"]:.0f} fps, ' \
+                f'dropped: {s["sequence_drops"]} capture {s["renderer_drops"]} render, ' \
+                f'p95 jitter: {jitter:.1f} ms, p95 latency: {latency:.1f} ms'
+        SDL_SetWindowTitle(self.window, title.encode())
+
+    def dump_stats(self, filename):
+        stats = json.dumps(self.stats(), indent=2)
+        if filename == '-':
+            print(stats)
+            return
+        try:
+            with open(filename, 'w') as f:
+                f.write(stats + '\n')
+        except Exception as e:
+            logging.warning(f'dump_stats: {e}')
+
     def toggle_fullscreen(self):
         self.fullscreen = not self.fullscreen
         SDL_SetWindowFullscreen(self.window, SDL_WINDOW_FULLSCREEN_DESKTOP if self.fullscreen else 0)
@@ -933,6 +1251,7 @@ class SDLCameraWindow():
             if SDL_RenderSetLogicalSize(self.renderer, self.cam.height, self.cam.width) != 0:
                 logging.warning(f'SDL_RenderSetlogicalSize failed: {SDL_GetError()}')
         self.match_window_to_logical()
+        self.pick_scale()
     
     def match_window_to_logical(self):
         if self.fullscreen:
@@ -965,6 +1284,8 @@ class SDLCameraWindow():
         pal = self.colormaps.get(colormap)    
 
         self.colormap = colormap
+        if self.decoder is not None:
+            self.decoder.pixelformat = TJPF_RGB if colormap == 'none' else TJPF_GRAY
         SDL_SetPaletteColors(self.surface[0].format[0].palette, pal, 0, 256)
 
     def step_colormap(self, step):
@@ -978,16 +1299,27 @@ class SDLCameraWindow():
 
     def stop_capturing(self):
         self.cam.stop()
+        if self.recorder is not None:
+            self.stop_recording()
+        if self.exporter is not None:
+            self.stop_exporting()
+        if self.mjpeg_decoder is not None:
+            self.mjpeg_decoder.stop()
+        self.mailbox.clear()
+        logging.info(f'{self.mailbox.dropped} frames dropped by the renderer')
 
     def close(self):
-        tj_destroy(self.tj)
         SDL_DestroyWindow(self.window)
         SDL_Quit()
         return self.returncode
 
 
+def output_filename(ext):
+    now = time.time()
+    return f'cameraview-{time.strftime("%Y%m%d-%H%M%S", time.localtime(now))}-{int(now * 1000) % 1000:03d}{ext}'
+
 def usage():
-    print(f'usage: {sys.argv[0]} [--help] [-d DEVICE] [-s SIZE] [-r ANGLE] [-m FLIP] [-c COLORMAP]\n')
+    print(f'usage: {sys.argv[0]} [--help] [-d DEVICE] [-s SIZE] [-r ANGLE] [-m FLIP] [-c COLORMAP] [-u DEPTH] [-t STATS] [-o RECORD] [-b BURST] [-e SOCKET] [-i]\n')
     print(f'optional arguments:')
     print(f'  -h, --help         show this help message and exit')
     print(f'  -d DEVICE          use DEVICE, default /dev/video0')
@@ -996,6 +1328,12 @@ def usage():
     print(f'  -m FLIP            mirror the image by FLIP, default no, (no, h, v, hv)')
     print(f'  -c COLORMAP        set colormap, default none')
     print(f'                    (none, grayscale, inferno, viridis, ironblack, rainbow)')
+    print(f'  -u DEPTH           capture into a ring of DEPTH own buffers (USERPTR), default mmap')
+    print(f'  -t STATS           write the frame stats as JSON to STATS on exit (- for stdout)')
+    print(f'  -o RECORD          record the frames to RECORD from the start, without re-encoding')
+    print(f'  -b BURST           the number of frames in a burst, default 10')
+    print(f'  -e SOCKET          share the capture buffers (dmabuf) on the unix SOCKET, e.g. for cameracapture -x')
+    print(f'  -i                 switch to the pixelformat=, resolution=, fps= lines of stdin, report the format on stdout')
     print()
     print(f'example:')
     print(f'  {sys.argv[0]} -d /dev/video2')
@@ -1005,11 +1343,17 @@ def usage():
     print(f'  r: ANGLE +90 (shift+r -90)')
     print(f'  m: FLIP next (shift+m prev)')
     print(f'  c: COLORMAP next (shift+c prev)')
+    print(f'  i: toggle the frame stats in the title')
+    print(f'  p: pixel format next (shift+p prev)')
+    print(f'  x: resolution next (shift+x prev)')
+    print(f'  t: fps next (shift+t prev)')
+    print(f'  v: start/stop recording to cameraview-DATE-TIME.v4l2rec')
+    print(f'  space: snapshot to cameraview-DATE-TIME.jpg (shift+space BURST frames to cameraview-DATE-TIME-burst.v4l2rec)')
 
 
 def main():
     try:
-        arguments, values = getopt.getopt(sys.argv[1:], 'hd:s:r:m:c:', ['help'])
+        arguments, values = getopt.getopt(sys.argv[1:], 'hd:s:r:m:c:u:t:o:b:e:i', ['help'])
     except getopt.error as err:
         print(err)
         usage()
@@ -1021,6 +1365,12 @@ def main():
     angle = 0
     flip = 0
     colormap = 'none'
+    ring_depth = 0
+    stats_file = None
+    record_file = None
+    burst_frames = 10
+    export_socket = None
+    format_requests = False
 
     for current_argument, current_value in arguments:
         if current_argument in ('-h', '--help'):
@@ -1050,13 +1400,33 @@ def main():
                 logging.warning(f'invalid FLIP value: {current_value}')
         elif current_argument == '-c':
             colormap = current_value
+        elif current_argument == '-u':
+            ring_depth = int(current_value)
+        elif current_argument == '-t':
+            stats_file = current_value
+        elif current_argument == '-o':
+            record_file = current_value
+        elif current_argument == '-b':
+            burst_frames = int(current_value)
+        elif current_argument == '-e':
+            export_socket = current_value
+        elif current_argument == '-i':
+            format_requests = True
 
 
     os.environ['SDL_VIDEO_X11_WMCLASS'] = 'hu.irl.cameractrls'
     os.environ['SDL_VIDEO_WAYLAND_WMCLASS'] = 'hu.irl.cameractrls'
 
-    win = SDLCameraWindow(device, width, height, angle, flip, colormap)
+    win = SDLCameraWindow(device, width, height, angle, flip, colormap, ring_depth, burst_frames)
+    if record_file is not None:
+        win.start_recording(record_file)
+    if export_socket is not None:
+        win.start_exporting(export_socket)
+    if format_requests:
+        win.start_format_requests(sys.stdin)
     win.start_capturing()
+    if stats_file is not None:
+        win.dump_stats(stats_file)
     return win.close()
 
 